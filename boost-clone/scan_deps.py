@@ -35,143 +35,960 @@ import re
 import sys
 import os
 import argparse
+import gzip
+import hashlib
+import json
+import mmap
+import multiprocessing
+import shlex
+import subprocess
 
 verbose = 0
 
+# Version of the scan cache format
+scan_cache_version = 3
+
+# Version of the dependencies.txt files written by this script
+dependencies_version = 1
+
+# Version of the <branch>.index.json format
+metadata_index_version = 2
+
+# Bundled metadata of the boost releases, loaded on first use
+metadata_archive_name = 'boost-metadata.json.gz'
+metadata_archive_version = 1
+metadata_archive = None
+
+# Boost includes in a line of a file
+include_regex = re.compile('[ \t]*#[ \t]*include[ \t]*["<](boost/[^">]*)[">]')
+
+# Boost includes in the contents of a file
+include_bytes_regex = re.compile(b'^[ \t]*#[ \t]*include[ \t]*["<](boost/[^">\r\n]*)[">]', re.MULTILINE)
+
+# All includes in a line of a file, and whether they are quoted
+any_include_regex = re.compile('[ \t]*#[ \t]*include[ \t]*(["<])([^">]*)[">]')
+
+# All includes in the contents of a file
+any_include_bytes_regex = re.compile(b'^[ \t]*#[ \t]*include[ \t]*(["<])([^">\r\n]*)[">]', re.MULTILINE)
+
+# Compiler options followed by an include directory
+include_dir_options = ['-I', '-iquote', '-isystem', '-idirafter', '/I']
+# The system and third-party headers usually come from the other options
+project_include_dir_options = ['-I', '-iquote', '/I']
+
+# Headers named after a module, such as boost/function.hpp
+module_header_regex = re.compile('([^\\.]*)\\.h[a-z]*$')
+
+# Key of the trie nodes that are modules
+trie_module_key = '.'
+
+# Macros predefined when evaluating preprocessor conditionals, mapping
+# each name to its value, or to None if it is known to be undefined.
+# Conditionals are not evaluated when this is None.
+predefined_macros = None
+
+# Macros of each --platform. Macros not listed here are unknown, and
+# both branches of the conditionals that depend on them are scanned.
+platform_macros = {
+    'linux': {'__linux__': '1', '__unix__': '1', '_WIN32': None, '_WIN64': None, '_MSC_VER': None,
+              '__CYGWIN__': None, '__MINGW32__': None, '__APPLE__': None, '__MACH__': None,
+              'BOOST_WINDOWS': None, 'BOOST_MSVC': None, 'BOOST_WINDOWS_API': None},
+    'macos': {'__APPLE__': '1', '__MACH__': '1', '__linux__': None, '_WIN32': None, '_WIN64': None,
+              '_MSC_VER': None, '__CYGWIN__': None, '__MINGW32__': None, 'BOOST_WINDOWS': None,
+              'BOOST_MSVC': None, 'BOOST_WINDOWS_API': None},
+    'windows': {'_WIN32': '1', 'BOOST_WINDOWS': '1', 'BOOST_WINDOWS_API': '1', '__linux__': None,
+                '__unix__': None, '__APPLE__': None, '__MACH__': None, '__CYGWIN__': None,
+                'BOOST_POSIX_API': None},
+}
+
+# Preprocessor directives and their arguments
+directive_regex = re.compile('[ \t]*#[ \t]*([a-z]+)(.*)$')
+
+# String and character literals, and the start of comments
+comment_regex = re.compile('"(?:\\\\.|[^"\\\\])*"|\'(?:\\\\.|[^\'\\\\])*\'|//|/\\*')
+
+# Tokens of the expressions in #if and #elif
+condition_token_regex = re.compile(
+    '[ \t]*(0[xX][0-9a-fA-F\']+[uUlL]*|[0-9][0-9\']*[uUlL]*|[A-Za-z_][A-Za-z_0-9]*|'
+    '\'(?:\\\\.|[^\'\\\\])*\'|"(?:\\\\.|[^"\\\\])*"|\\|\\||&&|==|!=|<=|>=|<<|>>|.)')
+
+# Binary operators in #if and #elif from the lowest to highest precedence
+condition_operators = [['||'], ['&&'], ['|'], ['^'], ['&'], ['==', '!='], ['<', '>', '<=', '>='], ['<<', '>>'],
+                       ['+', '-'], ['*', '/', '%']]
+
 
 def vprint(level, *args):
     if verbose >= level:
         print(*args)
 
 
-def is_module(m, gm):
-    return ('libs/' + m) in gm
+def set_verbose(level):
+    global verbose
+    verbose = level
+
 
+def set_scan_options(level, macros):
+    global predefined_macros
+    set_verbose(level)
+    predefined_macros = macros
 
-def module_for_header(h, x, gm):
+
+def module_trie(modules):
+    # Trie over the path components of the module names, such as
+    # numeric -> conversion for numeric/conversion
+    trie = {}
+    for module in modules:
+        node = trie
+        for part in module.split('/'):
+            node = node.setdefault(part, {})
+        node[trie_module_key] = True
+    return trie
+
+
+def module_for_header(h, x, trie):
     if h in x:
         return x[h]
     else:
-        # boost/function.hpp
-        m = re.match('boost/([^\\./]*)\\.h[a-z]*$', h)
+        # boost/function.hpp, boost/numeric/conversion.hpp,
+        # boost/numeric/conversion/header.hpp, or boost/function/header.hpp:
+        # the module is the longest match of the first two components
+        parts = h.split('/')
+        m = module_header_regex.match(parts[-1])
+        if m:
+            parts[-1] = m.group(1)
+        else:
+            parts.pop()
 
-        if m and is_module(m.group(1), gm):
-            return m.group(1)
+        module = None
+        node = trie
+        for i, part in enumerate(parts[1:3]):
+            node = node.get(part)
+            if node is None:
+                break
+            if trie_module_key in node:
+                module = '/'.join(parts[1:i + 2])
+        if parts[0] == 'boost' and module is not None:
+            return module
 
-        # boost/numeric/conversion.hpp
-        m = re.match('boost/([^/]*/[^\\./]*)\\.h[a-z]*$', h)
+        vprint(1, 'Cannot determine module for header', h)
 
-        if m and is_module(m.group(1), gm):
-            return m.group(1)
+        return None
 
-        # boost/numeric/conversion/header.hpp
-        m = re.match('boost/([^/]*/[^/]*)/', h)
 
-        if m and is_module(m.group(1), gm):
-            return m.group(1)
+def modules_for_headers(headers, exceptions, trie):
+    # Each distinct header is only resolved once
+    modules = {}
+    for h in headers:
+        if h not in modules:
+            modules[h] = module_for_header(h, exceptions, trie)
+    return set(modules.values())
 
-        # boost/function/header.hpp
-        m = re.match('boost/([^/]*)/', h)
 
-        if m and is_module(m.group(1), gm):
-            return m.group(1)
+def macro_value(text):
+    # The integer value of a macro, or None if it is not an integer
+    m = re.match('[ \t]*(0[xX][0-9a-fA-F\']+|[0-9][0-9\']*)[uUlL]*[ \t]*$', text)
+    if m:
+        return int(m.group(1).replace('\'', ''), 0 if m.group(1)[:2] in ('0x', '0X') else 10)
+    return None
 
-        vprint(1, 'Cannot determine module for header', h)
 
+def apply_condition_operator(op, a, b):
+    # Values are integers, or None when they depend on unknown macros
+    if op == '||':
+        if a or b:
+            return 1
+        return None if a is None or b is None else 0
+    if op == '&&':
+        if a == 0 or b == 0:
+            return 0
+        return None if a is None or b is None else 1
+    if a is None or b is None or (op in ('/', '%') and b == 0):
         return None
+    if op == '/':
+        return abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1)
+    if op == '%':
+        return a - b * apply_condition_operator('/', a, b)
+    return {
+        '|': lambda: a | b, '^': lambda: a ^ b, '&': lambda: a & b,
+        '==': lambda: int(a == b), '!=': lambda: int(a != b),
+        '<': lambda: int(a < b), '>': lambda: int(a > b), '<=': lambda: int(a <= b), '>=': lambda: int(a >= b),
+        '<<': lambda: a << b, '>>': lambda: a >> b,
+        '+': lambda: a + b, '-': lambda: a - b, '*': lambda: a * b,
+    }[op]()
 
 
-def scan_header_dependencies(f, exceptions, submodule_paths):
-    deps = set()
-    for line in f:
-        m = re.match('[ \t]*#[ \t]*include[ \t]*["<](boost/[^">]*)[">]', line)
-        if m:
-            h = m.group(1)
-            mod = module_for_header(h, exceptions, submodule_paths)
-            deps.add(mod)
-    return deps
+def parse_condition_unary(tokens, pos, macros):
+    token = tokens[pos]
+    if token in ('!', '-', '+', '~'):
+        value, pos = parse_condition_unary(tokens, pos + 1, macros)
+        if value is not None:
+            value = {'!': int(not value), '-': -value, '+': value, '~': ~value}[token]
+        return value, pos
+    if token == '(':
+        value, pos = parse_condition(tokens, pos + 1, macros)
+        if tokens[pos] != ')':
+            raise ValueError('expected )')
+        return value, pos + 1
+    if token == 'defined':
+        pos += 1
+        parenthesized = tokens[pos] == '('
+        if parenthesized:
+            pos += 1
+        name = tokens[pos]
+        pos += 1
+        if parenthesized:
+            if tokens[pos] != ')':
+                raise ValueError('expected )')
+            pos += 1
+        if name not in macros:
+            return None, pos
+        return int(macros[name] is not None), pos
+    if re.match('[0-9]', token):
+        return macro_value(token), pos + 1
+    if re.match('[A-Za-z_]', token):
+        pos += 1
+        if pos < len(tokens) and tokens[pos] == '(':
+            # Function-like macros such as __has_include(<...>) are unknown
+            depth = 0
+            while True:
+                depth += {'(': 1, ')': -1}.get(tokens[pos], 0)
+                pos += 1
+                if depth == 0:
+                    return None, pos
+        if token in ('true', 'false') and token not in macros:
+            return int(token == 'true'), pos
+        if token not in macros:
+            return None, pos
+        if macros[token] is None:
+            return 0, pos
+        return macro_value(macros[token]), pos
+    # Character literals and anything else
+    return None, pos + 1
+
+
+def parse_condition_binary(tokens, pos, level, macros):
+    if level == len(condition_operators):
+        return parse_condition_unary(tokens, pos, macros)
+    value, pos = parse_condition_binary(tokens, pos, level + 1, macros)
+    while pos < len(tokens) and tokens[pos] in condition_operators[level]:
+        op = tokens[pos]
+        other, pos = parse_condition_binary(tokens, pos + 1, level + 1, macros)
+        value = apply_condition_operator(op, value, other)
+    return value, pos
+
+
+def parse_condition(tokens, pos, macros):
+    value, pos = parse_condition_binary(tokens, pos, 0, macros)
+    if pos < len(tokens) and tokens[pos] == '?':
+        if_true, pos = parse_condition(tokens, pos + 1, macros)
+        if tokens[pos] != ':':
+            raise ValueError('expected :')
+        if_false, pos = parse_condition(tokens, pos + 1, macros)
+        if value is None:
+            value = if_true if if_true == if_false else None
+        else:
+            value = if_true if value else if_false
+    return value, pos
+
+
+def evaluate_condition(expression, macros):
+    # The value of an #if expression, or None if it cannot be determined
+    tokens = condition_token_regex.findall(expression)
+    while tokens and tokens[-1].strip() == '':
+        tokens.pop()
+    try:
+        value, pos = parse_condition(tokens, 0, macros)
+        if pos != len(tokens):
+            return None
+        return value
+    except (IndexError, ValueError, KeyError, OverflowError):
+        return None
+
 
+def strip_comments(line, in_comment):
+    # The line without comments, and whether a /* comment continues
+    # on the next line
+    text = ''
+    pos = 0
+    while pos < len(line):
+        if in_comment:
+            end = line.find('*/', pos)
+            if end == -1:
+                return text, True
+            pos = end + 2
+            in_comment = False
+            text += ' '
+            continue
+        m = comment_regex.search(line, pos)
+        if m is None:
+            text += line[pos:]
+            break
+        text += line[pos:m.start()]
+        if m.group(0) == '//':
+            break
+        if m.group(0) == '/*':
+            in_comment = True
+        else:
+            text += m.group(0)
+        pos = m.end()
+    return text, in_comment
 
-def scan_directory(d, exceptions, submodule_paths):
+
+def preprocessed_lines(lines, macros):
+    # The lines outside comments and outside the branches of #if, #ifdef,
+    # #ifndef, #elif and #else that are known to be skipped with these
+    # macros. Branches that depend on unknown macros are kept.
+    macros = dict(macros)
+    # Each conditional has the state of its current branch, which is
+    # True, False or None when unknown, and whether a previous branch
+    # was taken for sure or possibly
+    conditionals = []
+    in_comment = False
+    logical_line = ''
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.endswith('\\'):
+            logical_line += line[:-1]
+            continue
+        line, in_comment = strip_comments(logical_line + line, in_comment)
+        logical_line = ''
+
+        active = all(c['state'] is not False for c in conditionals)
+        certain = all(c['state'] is True for c in conditionals)
+        m = directive_regex.match(line)
+        directive = m.group(1) if m else None
+        if directive in ('if', 'ifdef', 'ifndef'):
+            if not active:
+                state = False
+            elif directive == 'if':
+                state = evaluate_condition(m.group(2), macros)
+            else:
+                name = m.group(2).strip()
+                state = None if name not in macros else macros[name] is not None
+                if directive == 'ifndef' and state is not None:
+                    state = not state
+            if state is not None:
+                state = bool(state)
+            conditionals.append({'state': state, 'parent_active': active, 'taken': state is True,
+                                 'maybe_taken': state is None})
+        elif directive in ('elif', 'else') and conditionals:
+            c = conditionals[-1]
+            if not c['parent_active'] or c['taken']:
+                c['state'] = False
+            else:
+                state = evaluate_condition(m.group(2), macros) if directive == 'elif' else True
+                if state is not None:
+                    state = bool(state)
+                if state is True and c['maybe_taken']:
+                    state = None
+                c['state'] = state
+                c['taken'] = state is True
+                c['maybe_taken'] = c['maybe_taken'] or state is None
+        elif directive == 'endif' and conditionals:
+            conditionals.pop()
+        elif active and directive in ('define', 'undef'):
+            d = re.match('[ \t]*([A-Za-z_][A-Za-z_0-9]*)(\\(?)[ \t]*(.*)$', m.group(2))
+            if d:
+                if not certain or d.group(2):
+                    macros.pop(d.group(1), None)
+                elif directive == 'define':
+                    macros[d.group(1)] = d.group(3)
+                else:
+                    macros[d.group(1)] = None
+        elif active:
+            yield line
+
+
+def scan_file_includes(fn):
+    # Only the boost headers are decoded, and files that do not
+    # mention boost/ at all are skipped without running the regex
+    vprint(2, 'Scanning file', fn)
+    headers = set()
+    with open(fn, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return headers
+        contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if contents.find(b'boost/') == -1:
+                return headers
+            if predefined_macros is not None:
+                text = contents[:].decode('latin-1')
+                for line in preprocessed_lines(text.splitlines(), predefined_macros):
+                    m = include_regex.match(line)
+                    if m:
+                        headers.add(m.group(1))
+            else:
+                for m in include_bytes_regex.finditer(contents):
+                    headers.add(m.group(1).decode('latin-1'))
+        finally:
+            contents.close()
+    return headers
+
+
+def list_directory_files(d):
     vprint(1, 'Scanning directory', d)
 
     if os.name == 'nt' and sys.version_info[0] < 3:
         d = unicode(d)
 
-    deps = set()
-    for root, dirs, files in os.walk(d):
-        for file in files:
-            fn = os.path.join(root, file)
-            vprint(2, 'Scanning file', fn)
-            if sys.version_info[0] < 3:
-                with open(fn, 'r') as f:
-                    deps.update(scan_header_dependencies(f, exceptions, submodule_paths))
-            else:
-                with open(fn, 'r', encoding='latin-1') as f:
-                    deps.update(scan_header_dependencies(f, exceptions, submodule_paths))
-    return deps
+    files = []
+    for root, dirs, filenames in os.walk(d):
+        for file in filenames:
+            files.append(os.path.join(root, file))
+    return files
+
+
+def map_files(function, files, jobs=1):
+    if jobs > 1 and len(files) > 64:
+        pool = multiprocessing.Pool(jobs, initializer=set_scan_options,
+                                    initargs=(verbose, predefined_macros))
+        try:
+            # Results come in the order of files, so the output does not
+            # depend on which worker finishes first
+            for result in pool.imap(function, files, 64):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for fn in files:
+            yield function(fn)
+
+
+def scan_files(files, jobs=1):
+    headers = set()
+    for file_headers in map_files(scan_file_includes, files, jobs):
+        headers.update(file_headers)
+    return headers
+
+
+def file_stamp(fn):
+    st = os.stat(fn)
+    return st.st_size, getattr(st, 'st_mtime_ns', int(st.st_mtime * 1000000000))
+
+
+def file_digest(fn):
+    # The git blob hash of the file, so it can be compared with the hashes
+    # in the git index without reading the file
+    h = hashlib.sha1()
+    h.update(b'blob ' + str(os.path.getsize(fn)).encode('ascii') + b'\0')
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def git_file_digests(d):
+    # The blob hashes in the git index of the files under d that are not
+    # modified in the work tree, as after a fresh checkout
+    if d is None:
+        return {}
+    try:
+        with open(os.devnull, 'w') as devnull:
+            staged = subprocess.check_output(['git', '-C', d, 'ls-files', '-s', '-z'], stderr=devnull)
+            modified = subprocess.check_output(['git', '-C', d, 'ls-files', '-m', '-z'], stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    digests = {}
+    for line in staged.split(b'\0'):
+        if b'\t' in line:
+            info, path = line.split(b'\t', 1)
+            digests[os.path.abspath(os.path.join(d, path.decode('utf-8')))] = info.split()[1].decode('ascii')
+    for path in modified.split(b'\0'):
+        if path:
+            digests.pop(os.path.abspath(os.path.join(d, path.decode('utf-8'))), None)
+    vprint(1, len(digests), 'file hashes from the git index of', d)
+    return digests
+
+
+def update_scan_cache_entry(item):
+    # Files whose modification time changed are only scanned again
+    # if their contents also changed. With all_includes, the entry also
+    # lists all the includes as [quoted, path] pairs.
+    fn, entry, all_includes = item
+    size, mtime = file_stamp(fn)
+    digest = file_digest(fn)
+    if entry is not None and entry['size'] == size and entry['sha1'] == digest:
+        entry['mtime'] = mtime
+        return fn, entry
+    entry = {'size': size, 'mtime': mtime, 'sha1': digest}
+    if all_includes:
+        includes = scan_file_all_includes(fn)
+        entry['headers'] = sorted(path for quoted, path in includes if path.startswith('boost/'))
+        entry['includes'] = sorted([quoted, path] for quoted, path in includes)
+    else:
+        entry['headers'] = sorted(scan_file_includes(fn))
+    return fn, entry
+
+
+def read_scan_cache(cache_path):
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+        # The included headers depend on the predefined macros
+        if cache.get('version') == scan_cache_version and cache.get('macros') == predefined_macros:
+            return cache['files']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def write_scan_cache(cache_path, entries):
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': scan_cache_version, 'macros': predefined_macros, 'files': entries}, f,
+                  separators=(',', ':'))
+    if hasattr(os, 'replace'):
+        os.replace(tmp_path, cache_path)
+    else:
+        # Python 2 can only rename over an existing file on POSIX
+        if os.name == 'nt' and os.path.exists(cache_path):
+            os.remove(cache_path)
+        os.rename(tmp_path, cache_path)
+
+
+def refresh_scan_cache(files, cache, entries, git_dir, git_digests, jobs=1, all_includes=False):
+    # Moves the cache entries of the unchanged files to entries and
+    # scans the other files again. git_digests is a list that holds the
+    # hashes of the git index of git_dir once they are first needed.
+    stale = []
+    for fn in files:
+        key = os.path.abspath(fn)
+        entry = cache.get(key)
+        if entry is not None and all_includes and 'includes' not in entry:
+            entry = None
+        if entry is not None and (entry['size'], entry['mtime']) == file_stamp(fn):
+            entries[key] = entry
+            continue
+        if entry is not None:
+            if not git_digests:
+                git_digests.append(git_file_digests(git_dir))
+            if git_digests[0].get(key) == entry['sha1']:
+                entry['size'], entry['mtime'] = file_stamp(fn)
+                entries[key] = entry
+                continue
+        stale.append((fn, entry, all_includes))
+
+    for fn, entry in map_files(update_scan_cache_entry, stale, jobs):
+        entries[os.path.abspath(fn)] = entry
+    return len(files) - len(stale)
+
+
+def scan_files_cached(files, cache_path, jobs=1, git_dir=None):
+    # The cache stores the boost headers included by each file, keyed
+    # by the file path, size and modification time, or git blob hash.
+    # After a fresh checkout, the hashes come from the git index of
+    # git_dir, so unchanged files are not even read.
+    # Only the files scanned in this run are kept in the cache.
+    cache = read_scan_cache(cache_path)
+    entries = {}
+    unchanged = refresh_scan_cache(files, cache, entries, git_dir, [], jobs)
+    vprint(1, unchanged, 'files unchanged since the last scan')
+    write_scan_cache(cache_path, entries)
 
+    headers = set()
+    for entry in entries.values():
+        headers.update(entry['headers'])
+    return headers
 
-def list_boost_dependencies(dir, subdirs, exceptions, submodule_paths):
+
+def list_boost_dependencies(dir, subdirs, exceptions, trie, jobs=1, cache_path=None):
     vprint(1, 'Scanning dir', dir)
-    deps = set()
+    files = []
     for subdir in subdirs:
-        deps.update(scan_directory(os.path.join(dir, subdir), exceptions, submodule_paths))
-    return deps
+        files.extend(list_directory_files(os.path.join(dir, subdir)))
+    if cache_path:
+        headers = scan_files_cached(files, cache_path, jobs, dir)
+    else:
+        headers = scan_files(files, jobs)
+    vprint(1, len(files), 'files include', len(headers), 'boost headers')
+    return modules_for_headers(headers, exceptions, trie)
+
+
+def scan_file_all_includes(fn):
+    # All the includes of a file as (quoted, path) pairs, used to
+    # follow the project headers
+    vprint(2, 'Scanning file', fn)
+    includes = set()
+    with open(fn, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return includes
+        contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if predefined_macros is not None:
+                text = contents[:].decode('latin-1')
+                for line in preprocessed_lines(text.splitlines(), predefined_macros):
+                    m = any_include_regex.match(line)
+                    if m:
+                        includes.add((m.group(1) == '"', m.group(2)))
+            else:
+                for m in any_include_bytes_regex.finditer(contents):
+                    includes.add((m.group(1) == b'"', m.group(2).decode('latin-1')))
+        finally:
+            contents.close()
+    return includes
+
+
+def scan_file_all_includes_by_item(item):
+    return item, scan_file_all_includes(item[0])
+
+
+def compile_command_include_dirs(entry, options=include_dir_options):
+    # The include directories of a compile_commands.json entry given
+    # with options, relative to its directory
+    if 'arguments' in entry:
+        arguments = entry['arguments']
+    else:
+        arguments = shlex.split(entry['command'], posix=os.name != 'nt')
+    directory = entry.get('directory', '.')
+    include_dirs = []
+    for i, argument in enumerate(arguments):
+        for option in options:
+            if argument == option and i + 1 < len(arguments):
+                include_dirs.append(arguments[i + 1])
+            elif argument.startswith(option) and len(argument) > len(option):
+                include_dirs.append(argument[len(option):])
+    return [os.path.normpath(os.path.join(directory, d)) for d in include_dirs]
+
+
+def read_compile_commands(path):
+    # The translation units in compile_commands.json and their include
+    # directories. A file compiled more than once is only scanned once.
+    # The project directories are those of the translation units and
+    # their -I and -iquote directories.
+    vprint(1, 'Reading', path)
+    with open(path, 'r') as f:
+        entries = json.load(f)
+    units = {}
+    project_dirs = set()
+    for entry in entries:
+        fn = os.path.normpath(os.path.join(entry.get('directory', '.'), entry['file']))
+        if fn not in units and os.path.exists(fn):
+            units[fn] = compile_command_include_dirs(entry)
+            project_dirs.add(os.path.dirname(fn))
+            project_dirs.update(compile_command_include_dirs(entry, project_include_dir_options))
+    return units, sorted(project_dirs)
+
+
+def resolve_include(quoted, path, fn, include_dirs):
+    # Quoted includes are looked up next to the including file first
+    dirs = [os.path.dirname(fn)] + include_dirs if quoted else include_dirs
+    for d in dirs:
+        candidate = os.path.normpath(os.path.join(d, path))
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def is_in_directories(fn, dirs):
+    fn = os.path.abspath(fn)
+    return any(fn == d or fn.startswith(os.path.join(d, '')) for d in dirs)
+
+
+def common_directory(paths):
+    prefix = os.path.commonprefix([os.path.join(os.path.abspath(p), '') for p in paths])
+    return os.path.dirname(prefix) if prefix else None
+
+
+def scan_included_files(units, project_dirs, jobs=1, cache_path=None):
+    # The boost headers included by the translation units and by the
+    # project headers they reach. Includes are resolved as in the
+    # compiler, and only the files under project_dirs are followed, so
+    # the system and third-party headers are not scanned. The headers
+    # of a boost library are followed too when it is the project.
+    # Each file is only scanned once, with the include directories of
+    # the first translation unit that reaches it.
+    project_dirs = [os.path.abspath(d) for d in project_dirs]
+    cache = read_scan_cache(cache_path) if cache_path else None
+    entries = {}
+    git_dir = common_directory(project_dirs)
+    git_digests = []
+    unchanged = 0
+    headers = set()
+    visited = set(units.keys())
+    frontier = sorted(units.items())
+    while frontier:
+        if cache is None:
+            scanned = map_files(scan_file_all_includes_by_item, frontier, jobs)
+        else:
+            unchanged += refresh_scan_cache([fn for fn, include_dirs in frontier], cache, entries, git_dir,
+                                            git_digests, jobs, True)
+            scanned = []
+            for item in frontier:
+                entry = entries[os.path.abspath(item[0])]
+                scanned.append((item, [(quoted, path) for quoted, path in entry['includes']]))
+        next_frontier = []
+        for (fn, include_dirs), includes in scanned:
+            for quoted, path in includes:
+                if path.startswith('boost/'):
+                    headers.add(path)
+                included = resolve_include(quoted, path, fn, include_dirs)
+                if included is not None and included not in visited and is_in_directories(included, project_dirs):
+                    visited.add(included)
+                    next_frontier.append((included, include_dirs))
+        frontier = next_frontier
+    if cache is not None:
+        vprint(1, unchanged, 'files unchanged since the last scan')
+        write_scan_cache(cache_path, entries)
+    vprint(1, len(visited), 'files reached from', len(units), 'translation units')
+    return headers
+
+
+def list_compile_commands_dependencies(path, exceptions, trie, jobs=1, cache_path=None, project_dir=None):
+    units, project_dirs = read_compile_commands(path)
+    headers = scan_included_files(units, [project_dir] if project_dir else project_dirs, jobs, cache_path)
+    vprint(1, len(units), 'translation units include', len(headers), 'boost headers')
+    return modules_for_headers(headers, exceptions, trie)
+
+
+def metadata_dir():
+    # The metadata files are next to the script, which is the current
+    # directory when the script is run as "python scan_deps.py"
+    return os.path.dirname(os.path.abspath(sys.argv[0]))
+
+
+def metadata_path(branch, extension):
+    return os.path.join(metadata_dir(), branch + extension)
+
+
+def metadata_archive_path():
+    return os.path.join(metadata_dir(), metadata_archive_name)
+
+
+def read_metadata_archive():
+    # boost-metadata.json.gz has the metadata files of each boost release
+    # tag and main branch. Identical files are only stored once in "texts",
+    # and "refs" maps each ref to the index of each of its files.
+    global metadata_archive
+    if metadata_archive is None:
+        metadata_archive = {'texts': [], 'refs': {}}
+        archive_path = metadata_archive_path()
+        if os.path.exists(archive_path):
+            vprint(1, 'Reading', archive_path)
+            with gzip.open(archive_path, 'rb') as f:
+                archive = json.loads(f.read().decode('utf-8'))
+            if archive.get('version') == metadata_archive_version:
+                metadata_archive = archive
+    return metadata_archive
+
+
+def read_metadata_text(branch, extension, url, offline=False):
+    # The local <branch><extension> file, then the bundled archive, and
+    # only then the network, saving the downloaded file for the next runs
+    path = metadata_path(branch, extension)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return f.read()
+
+    archive = read_metadata_archive()
+    ref = archive['refs'].get(branch, {})
+    if ref.get(extension) is not None:
+        return archive['texts'][ref[extension]]
+
+    if not offline:
+        vprint(1, 'Downloading', url)
+        try:
+            import requests
+            response = requests.get(url, timeout=30)
+            if response.status_code == 200:
+                with open(path, 'w') as f:
+                    f.write(response.text)
+                return response.text
+            vprint(1, 'Cannot download', url, '(HTTP ' + str(response.status_code) + ')')
+        except Exception as e:
+            vprint(1, 'Cannot download', url, '(' + str(e) + ')')
 
+    sys.stderr.write('No ' + branch + extension + ' in ' + os.path.dirname(path) + ' or in ' +
+                     metadata_archive_name + (' and it could not be downloaded' if not offline else '') + '\n')
+    sys.exit(1)
 
-def read_exceptions(branch):
+
+def read_exceptions(branch, offline=False):
     # exceptions.txt is the output of "boostdep --list-exceptions"
     vprint(1, 'Reading exceptions.txt')
     x = {}
     module = None
 
-    exceptions_path = os.path.join(os.path.dirname(sys.argv[0]), branch + '.exceptions.txt')
-    if not os.path.exists(exceptions_path):
-        import requests
-        url = "https://raw.githubusercontent.com/boostorg/boostdep/" + branch + "/depinst/exceptions.txt"
-        response = requests.get(url)
-        if response.status_code == 200:
-            content = response.text
-            with open(exceptions_path, "w") as f:
-                f.write(content)
-
-    with open(exceptions_path, 'r') as f:
-        for line in f:
-            line = line.rstrip()
-            m = re.match('(.*):$', line)
-            if m:
-                module = m.group(1).replace('~', '/')
-            else:
-                header = line.lstrip()
-                x[header] = module
+    url = "https://raw.githubusercontent.com/boostorg/boostdep/" + branch + "/depinst/exceptions.txt"
+    for line in read_metadata_text(branch, '.exceptions.txt', url, offline).splitlines():
+        line = line.rstrip()
+        m = re.match('(.*):$', line)
+        if m:
+            module = m.group(1).replace('~', '/')
+        else:
+            header = line.lstrip()
+            x[header] = module
     return x
 
 
-def read_gitmodules(branch):
+def read_gitmodules(branch, offline=False):
     vprint(1, 'Reading .gitmodules')
     gm = []
 
-    gitmodules_path = os.path.join(os.path.dirname(sys.argv[0]), branch + '.gitmodules')
-    if not os.path.exists(gitmodules_path):
-        import requests
-        url = "https://raw.githubusercontent.com/boostorg/boost/" + branch + "/.gitmodules"
-        response = requests.get(url)
-        if response.status_code == 200:
-            content = response.text
-            with open(gitmodules_path, "w") as f:
-                f.write(content)
-
-    with open(gitmodules_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            m = re.match('path[ \t]*=[ \t]*(.*)$', line)
-            if m:
-                gm.append(m.group(1))
+    url = "https://raw.githubusercontent.com/boostorg/boost/" + branch + "/.gitmodules"
+    for line in read_metadata_text(branch, '.gitmodules', url, offline).splitlines():
+        line = line.strip()
+        m = re.match('path[ \t]*=[ \t]*(.*)$', line)
+        if m:
+            gm.append(m.group(1))
 
     return gm
 
 
+def git_output(repo, *args):
+    return subprocess.check_output(('git', '-C', repo) + args).decode('utf-8')
+
+
+def write_metadata_archive(boost_repo):
+    # boost_repo is a clone of the super-project with all tags, and the
+    # tools/boostdep submodule cloned with its full history
+    refs = [ref for ref in git_output(boost_repo, 'tag', '--list', 'boost-*').split()]
+    for branch in ['master', 'develop']:
+        if subprocess.call(['git', '-C', boost_repo, 'rev-parse', '--verify', '--quiet', branch],
+                           stdout=subprocess.PIPE) == 0:
+            refs.append(branch)
+
+    texts = []
+    text_ids = {}
+    archive_refs = {}
+    for ref in refs:
+        vprint(1, 'Reading metadata of', ref)
+        files = {}
+        try:
+            files['.gitmodules'] = git_output(boost_repo, 'show', ref + ':.gitmodules')
+            boostdep = git_output(boost_repo, 'ls-tree', ref, 'tools/boostdep').split()
+            if len(boostdep) >= 3:
+                boostdep_repo = os.path.join(boost_repo, 'tools', 'boostdep')
+                files['.exceptions.txt'] = git_output(boostdep_repo, 'show', boostdep[2] + ':depinst/exceptions.txt')
+        except subprocess.CalledProcessError:
+            vprint(1, 'Incomplete metadata for', ref)
+        dependencies_file = dependencies_path(ref)
+        if os.path.exists(dependencies_file):
+            with open(dependencies_file, 'r') as f:
+                files['.dependencies.txt'] = f.read()
+        archive_refs[ref] = {}
+        for extension, text in sorted(files.items()):
+            if text not in text_ids:
+                text_ids[text] = len(texts)
+                texts.append(text)
+            archive_refs[ref][extension] = text_ids[text]
+
+    archive_path = metadata_archive_path()
+    archive = {'version': metadata_archive_version, 'texts': texts, 'refs': archive_refs}
+    # No timestamp in the gzip header, so the archive only changes with its contents
+    with open(archive_path, 'wb') as raw:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0) as f:
+            f.write(json.dumps(archive, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+    vprint(1, 'Metadata of', len(archive_refs), 'refs saved to', archive_path)
+
+
+def read_metadata_index(branch, offline=False):
+    # exceptions.txt and .gitmodules compiled into the header -> module
+    # exceptions and a trie of the module names. The index is rebuilt
+    # when the text files change.
+    index_path = metadata_path(branch, '.index.json')
+    source_paths = [metadata_path(branch, '.exceptions.txt'), metadata_path(branch, '.gitmodules'),
+                    metadata_archive_path()]
+    stamps = [list(file_stamp(p)) if os.path.exists(p) else None for p in source_paths]
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if index['version'] == metadata_index_version and (index['stamps'] == stamps or stamps == [None, None, None]):
+            vprint(1, 'Reading', index_path)
+            return index['exceptions'], index['modules'], index['trie']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    exceptions = read_exceptions(branch, offline)
+    modules = sorted(path[len('libs/'):] for path in read_gitmodules(branch, offline) if path.startswith('libs/'))
+    trie = module_trie(modules)
+    index = {
+        'version': metadata_index_version,
+        'stamps': [list(file_stamp(p)) if os.path.exists(p) else None for p in source_paths],
+        'exceptions': exceptions,
+        'modules': modules,
+        'trie': trie,
+    }
+    try:
+        with open(index_path, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        vprint(1, 'Index saved to', index_path)
+    except (IOError, OSError):
+        vprint(1, 'Cannot save index to', index_path)
+    return exceptions, modules, trie
+
+
+def scan_file_includes_by_path(fn):
+    return fn, scan_file_includes(fn)
+
+
+def dependencies_path(branch):
+    return metadata_path(branch, '.dependencies.txt')
+
+
+def read_dependencies(branch):
+    # The dependencies of each module, in the format of
+    # "boostdep --list-dependencies" or written by write_dependencies
+    vprint(1, 'Reading dependencies.txt')
+    deps = {}
+
+    path = dependencies_path(branch)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+    else:
+        archive = read_metadata_archive()
+        ref = archive['refs'].get(branch, {})
+        if ref.get('.dependencies.txt') is None:
+            return None
+        lines = archive['texts'][ref['.dependencies.txt']].splitlines()
+
+    for line in lines:
+        line = line.strip()
+        m = re.match('([^ #]+)[ \t]*->(.*)$', line)
+        if m:
+            module = m.group(1).replace('~', '/')
+            deps[module] = set(d.replace('~', '/') for d in m.group(2).split())
+    return deps
+
+
+def write_dependencies(boost_root, branch, exceptions, modules, trie, jobs=1):
+    # The dependencies of a module are the modules included by its
+    # include and src directories, as in boostdep
+    vprint(1, 'Scanning modules in', boost_root)
+    file_modules = {}
+    for module in modules:
+        for subdir in ['include', 'src']:
+            for fn in list_directory_files(os.path.join(boost_root, 'libs', module, subdir)):
+                file_modules[fn] = module
+
+    module_headers = dict((module, set()) for module in modules)
+    for fn, headers in map_files(scan_file_includes_by_path, list(file_modules), jobs):
+        module_headers[file_modules[fn]].update(headers)
+
+    path = dependencies_path(branch)
+    with open(path, 'w') as f:
+        f.write('# Dependencies of the boost modules in ' + branch + ', version ' + str(dependencies_version) + '\n')
+        for module in sorted(module_headers):
+            deps = modules_for_headers(module_headers[module], exceptions, trie)
+            deps.discard(module)
+            deps.discard(None)
+            f.write(module.replace('/', '~') + ' -> ' + ' '.join(sorted(d.replace('/', '~') for d in deps)) + '\n')
+    vprint(1, 'Dependencies saved to', path)
+
+
+def transitive_dependencies(modules, deps):
+    result = set()
+    stack = list(modules)
+    while stack:
+        module = stack.pop()
+        if module in result:
+            continue
+        result.add(module)
+        stack.extend(deps.get(module, ()))
+    return result
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Installs the dependencies needed to test a Boost library.')
 
@@ -185,6 +1002,36 @@ if __name__ == "__main__":
                         metavar='DIR', action='append', default=[])
     parser.add_argument('-N', '--ignore', help="exclude top-level dependency even when found in scan; can be repeated",
                         metavar='LIB', action='append', default=[])
+    parser.add_argument('-j', '--jobs', help="number of processes scanning files (0 to use all CPUs)", type=int,
+                        default=0)
+    parser.add_argument('--cache', help="file where the boost headers included by each file are cached between runs",
+                        metavar='FILE')
+    parser.add_argument('-T', '--transitive',
+                        help="also list the dependencies of the dependencies, from <branch>.dependencies.txt",
+                        action='store_true')
+    parser.add_argument('--write-dependencies',
+                        help="scan the modules of a boost super-project and save their dependencies in "
+                             "<branch>.dependencies.txt", metavar='BOOST_ROOT')
+    parser.add_argument('-D', '--define',
+                        help="macro defined when evaluating #if, #ifdef and #elif to skip the includes in dead "
+                             "branches; can be repeated", metavar='NAME[=VALUE]', action='append', default=[])
+    parser.add_argument('-U', '--undefine', help="macro undefined when evaluating conditionals; can be repeated",
+                        metavar='NAME', action='append', default=[])
+    parser.add_argument('--platform', help="define and undefine the macros of a platform",
+                        choices=sorted(platform_macros.keys()))
+    parser.add_argument('--preprocess',
+                        help="skip the includes in comments and in dead conditional branches, such as #if 0, "
+                             "even without -D, -U or --platform", action='store_true')
+    parser.add_argument('--compile-commands',
+                        help="scan the translation units in this compile_commands.json and the project headers they "
+                             "reach through their -I, -iquote and -isystem directories, instead of the "
+                             "directories; the project is --dir, or the directories of the translation units and "
+                             "their -I and -iquote directories", metavar='FILE')
+    parser.add_argument('--offline', help="never download the metadata files missing locally and in the archive",
+                        action='store_true')
+    parser.add_argument('--write-metadata-archive',
+                        help="save the metadata of all release tags of a boost super-project clone in "
+                             + metadata_archive_name, metavar='BOOST_REPO')
     parser.add_argument('-v', '--verbose', help='enable verbose output', action='count', default=0)
     parser.add_argument('-q', '--quiet', help='quiet output (opposite of -v)', action='count', default=0)
 
@@ -196,11 +1043,27 @@ if __name__ == "__main__":
     vprint(2, '-I:', args.include)
     vprint(2, '-N:', args.ignore)
 
-    exceptions = read_exceptions(args.branch)
+    if args.preprocess or args.define or args.undefine or args.platform:
+        predefined_macros = dict(platform_macros.get(args.platform, {}))
+        for define in args.define:
+            name, separator, value = define.partition('=')
+            predefined_macros[name] = value if separator else '1'
+        for name in args.undefine:
+            predefined_macros[name] = None
+        vprint(2, 'Macros:', predefined_macros)
+
+    if args.write_metadata_archive:
+        write_metadata_archive(args.write_metadata_archive)
+        sys.exit(0)
+
+    exceptions, modules, trie = read_metadata_index(args.branch, args.offline)
     vprint(2, 'Exceptions:', exceptions)
+    vprint(2, 'Modules:', modules)
 
-    submodule_paths = read_gitmodules(args.branch)
-    vprint(2, '.gitmodules:', submodule_paths)
+    jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+    if args.write_dependencies:
+        write_dependencies(args.write_dependencies, args.branch, exceptions, modules, trie, jobs)
+        sys.exit(0)
 
     subdirs = ['include', 'src', 'source', 'test', 'tests', 'example', 'examples']
     for subdir in args.exclude:
@@ -211,7 +1074,11 @@ if __name__ == "__main__":
             subdirs.append(subdir)
     vprint(1, 'Directories to scan:', *subdirs)
 
-    modules = list_boost_dependencies(args.dir, subdirs, exceptions, submodule_paths)
+    if args.compile_commands:
+        modules = list_compile_commands_dependencies(args.compile_commands, exceptions, trie, jobs, args.cache,
+                                                     args.dir)
+    else:
+        modules = list_boost_dependencies(args.dir, subdirs, exceptions, trie, jobs, args.cache)
     for ignored in args.ignore:
         if ignored in modules:
             modules.remove(ignored)
@@ -219,5 +1086,22 @@ if __name__ == "__main__":
     while None in modules:
         modules.remove(None)
 
+    if args.transitive:
+        deps = read_dependencies(args.branch)
+        if deps is None:
+            # The archive only has the dependencies of the main branches
+            # and of the latest releases
+            sys.stderr.write('Warning: no dependencies for ' + args.branch + ' in ' + dependencies_path(args.branch) +
+                             ' or in ' + metadata_archive_name + '; only direct dependencies are listed\n')
+            archived = sorted(ref for ref, files in read_metadata_archive()['refs'].items()
+                              if files.get('.dependencies.txt') is not None)
+            if archived:
+                sys.stderr.write('The archive has the dependencies of ' + ', '.join(archived) + '\n')
+            sys.stderr.write('Run --write-dependencies on a checkout of ' + args.branch + ' to add them\n')
+        else:
+            modules = transitive_dependencies(modules, deps)
+            for ignored in args.ignore:
+                modules.discard(ignored)
+
     sorted_modules = sorted(modules)
     print(' '.join(sorted_modules))
@@ -0,0 +1,56 @@
+#!/bin/bash
+# Description: Update boost-metadata.json.gz, the metadata of all boost releases used by scan_deps.py
+#
+# The archive has the .gitmodules and exceptions.txt of every boost-* tag and
+# of the master and develop branches, so scan_deps.py can find the modules of
+# any release without downloading anything. It also has the dependencies of
+# each module in master, develop and the latest releases, so scan_deps.py -T
+# can list the transitive dependencies before boost is cloned.
+#
+# Usage: ./update-metadata.sh [WORK_DIR]
+# DEPENDENCY_RELEASES sets how many of the latest releases get their
+# module dependencies (5 by default).
+# The boost clones are kept in WORK_DIR, if provided, to speed up the next updates.
+
+set -e
+
+script_dir="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+work_dir=${1:-$(mktemp -d)}
+boost_repo="$work_dir/boost"
+
+echo "==== Fetch boost super-project ===="
+if [ ! -d "$boost_repo" ]; then
+    git clone --no-checkout https://github.com/boostorg/boost.git "$boost_repo"
+fi
+git -C "$boost_repo" fetch --tags --update-head-ok origin master:master develop:develop
+
+echo "==== Fetch boostdep ===="
+if [ ! -d "$boost_repo/tools/boostdep/.git" ]; then
+    git clone --no-checkout https://github.com/boostorg/boostdep.git "$boost_repo/tools/boostdep"
+fi
+git -C "$boost_repo/tools/boostdep" fetch origin
+
+echo "==== Write metadata archive ===="
+python "$script_dir/scan_deps.py" --write-metadata-archive "$boost_repo" -v
+
+# The dependencies of the modules need a checkout of all modules at each ref
+releases=$(git -C "$boost_repo" tag --list 'boost-[0-9]*' | grep -E '^boost-[0-9]+\.[0-9]+\.[0-9]+$' | sort -V | tail -n "${DEPENDENCY_RELEASES:-5}")
+for ref in master develop $releases; do
+    echo "==== Write dependencies of $ref ===="
+    checkout="$work_dir/checkout-$ref"
+    # Release tags never change, but the branches do
+    if [ "$ref" == "master" ] || [ "$ref" == "develop" ]; then
+        rm -rf "$checkout"
+    fi
+    if [ ! -d "$checkout" ]; then
+        git clone --depth 1 --branch "$ref" --recurse-submodules --shallow-submodules --jobs 8 \
+            https://github.com/boostorg/boost.git "$checkout"
+    fi
+    python "$script_dir/scan_deps.py" --branch "$ref" --offline --write-dependencies "$checkout"
+done
+
+echo "==== Write metadata archive with dependencies ===="
+python "$script_dir/scan_deps.py" --write-metadata-archive "$boost_repo" -v
+for ref in master develop $releases; do
+    rm -f "$script_dir/$ref.dependencies.txt" "$script_dir/$ref.index.json"
+done
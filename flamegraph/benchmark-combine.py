@@ -0,0 +1,88 @@
+#
+# Copyright (c) 2023 Alan de Freitas (alandefreitas@gmail.com)
+#
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE_1_0.txt or copy at http://www.boost.org/LICENSE_1_0.txt)
+#
+# Official repository: https://github.com/alandefreitas/cpp-actions
+#
+
+"""Benchmark combine-traces.py on synthetic builds.
+
+A build directory is generated with generate-traces.py for each number
+of translation units, and combine-traces.py is run on it in a separate
+process. The wall time, peak resident memory and events per second of
+each run are printed as a markdown table.
+
+Run with (e.g.): python benchmark-combine.py --tus 10 1000 10000"""
+
+import argparse
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location('generate_traces', os.path.join(script_dir, 'generate-traces.py'))
+generate_traces = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(generate_traces)
+
+
+def format_memory(max_rss):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    kilobytes = max_rss / 1024 if sys.platform == 'darwin' else max_rss
+    if kilobytes < 1024:
+        return f'{round(kilobytes, 2)} KB'
+    elif kilobytes < 1024 * 1024:
+        return f'{round(kilobytes / 1024, 2)} MB'
+    return f'{round(kilobytes / 1024 / 1024, 2)} GB'
+
+
+def run_combiner(build_dir, combine_args):
+    """Run combine-traces.py and return its wall time and peak resident memory."""
+    command = [sys.executable, os.path.join(script_dir, 'combine-traces.py'),
+               '--build-dir', build_dir, '--source-dir', build_dir] + combine_args
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    # wait4 gives the resource usage of this process only
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    exit_code = os.waitstatus_to_exitcode(status)
+    if exit_code != 0:
+        raise RuntimeError(f'combine-traces.py failed with exit code {exit_code}')
+    return elapsed, usage.ru_maxrss
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark combine-traces.py on synthetic builds.')
+    parser.add_argument('--work-dir', help="directory where the synthetic builds are generated "
+                                           "(a temporary directory by default)")
+    parser.add_argument('--keep', action='store_true', help="keep the synthetic builds")
+    parser.add_argument('--combine-args', default='',
+                        help="extra arguments for combine-traces.py (e.g. '-j 0 --timeline real')")
+    parser.add_argument('--tus', type=int, nargs='+', default=[10, 1000, 10000],
+                        help="numbers of translation units to benchmark")
+    generate_traces.add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='combine-traces-benchmark-')
+    combine_args = args.combine_args.split()
+
+    print('| TUs | Events | Wall Time | Peak RSS | Events/s |')
+    print('| --- | ------ | --------- | -------- | -------- |')
+    try:
+        for tus in args.tus:
+            build_dir = os.path.join(work_dir, f'build-{tus}')
+            generator_args = argparse.Namespace(**{**vars(args), 'tus': tus})
+            event_count = generate_traces.generate_build_dir(build_dir, generator_args)
+            elapsed, max_rss = run_combiner(build_dir, combine_args)
+            print(f'| {tus} | {event_count} | {round(elapsed, 2)} s | {format_memory(max_rss)} '
+                  f'| {round(event_count / elapsed)} |', flush=True)
+            if not args.keep:
+                shutil.rmtree(build_dir)
+    finally:
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2023 Alan de Freitas (alandefreitas@gmail.com)
+#
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE_1_0.txt or copy at http://www.boost.org/LICENSE_1_0.txt)
+#
+# Official repository: https://github.com/alandefreitas/cpp-actions
+#
+
+"""Benchmark the region de-duplication used by combine-traces.py.
+
+The fixture time-traces are scaled up synthetically by repeating their
+events at increasing time offsets, which gives a single large translation
+unit. The parsing and instantiation totals are then computed with the
+previous linear scan over the regions and with the RegionSet index, and
+the results are checked to be the same.
+
+Run with (e.g.): python benchmark-regions.py --scale 1 10 100"""
+
+import argparse
+import glob
+import importlib.util
+import os
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location('combine_traces', os.path.join(script_dir, 'combine-traces.py'))
+combine_traces = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(combine_traces)
+
+
+def load_region_events(trace_files):
+    events = []
+    for trace_file in trace_files:
+        for event in combine_traces.iter_trace_events(trace_file):
+            if event['ph'] == 'M' or 'dur' not in event:
+                continue
+            name = event['name']
+            if name == 'Source' or name == 'PerformPendingInstantiations' or name.startswith('Instantiate'):
+                events.append((name, int(event['ts']), int(event['dur'])))
+    return events
+
+
+def scale_events(events, scale):
+    begin = min(ts for _, ts, _ in events)
+    span = max(ts + dur for _, ts, dur in events) - begin + 1
+    scaled = []
+    for i in range(scale):
+        offset = i * span
+        scaled.extend((name, ts + offset, dur) for name, ts, dur in events)
+    return sorted(scaled, key=lambda x: x[2], reverse=True)
+
+
+def linear_totals(events):
+    parsing = (0, 0)
+    instantiations = (0, 0)
+    parsing_regions = []
+    instantiation_regions = []
+    for name, ts, dur in events:
+        if name == 'Source':
+            accounted_for = False
+            for parsing_region in parsing_regions:
+                if parsing_region[0] <= ts < parsing_region[1]:
+                    accounted_for = True
+                    break
+            if not accounted_for:
+                parsing = (parsing[0] + 1, parsing[1] + dur)
+                parsing_regions.append((ts, ts + dur))
+        elif name == 'PerformPendingInstantiations':
+            instantiations = (instantiations[0] + 1, instantiations[1] + dur)
+            instantiation_regions.append((ts, ts + dur))
+        else:
+            accounted_for = False
+            for instantiation_region in instantiation_regions:
+                if instantiation_region[0] <= ts < instantiation_region[1]:
+                    accounted_for = True
+                    break
+            if not accounted_for:
+                instantiations = (instantiations[0] + 1, instantiations[1] + dur)
+                instantiation_regions.append((ts, ts + dur))
+    return parsing, instantiations
+
+
+def indexed_totals(events):
+    parsing = (0, 0)
+    instantiations = (0, 0)
+    parsing_regions = combine_traces.RegionSet()
+    instantiation_regions = combine_traces.RegionSet()
+    for name, ts, dur in events:
+        if name == 'Source':
+            if ts not in parsing_regions:
+                parsing = (parsing[0] + 1, parsing[1] + dur)
+                parsing_regions.add(ts, ts + dur)
+        elif name == 'PerformPendingInstantiations':
+            instantiations = (instantiations[0] + 1, instantiations[1] + dur)
+            instantiation_regions.add(ts, ts + dur)
+        else:
+            if ts not in instantiation_regions:
+                instantiations = (instantiations[0] + 1, instantiations[1] + dur)
+                instantiation_regions.add(ts, ts + dur)
+    return parsing, instantiations
+
+
+def measure(fn, events):
+    start = time.perf_counter()
+    result = fn(events)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the region de-duplication in combine-traces.py.')
+    parser.add_argument('--fixtures-dir', help="directory with time-trace fixtures",
+                        default=os.path.join(script_dir, 'fixtures'))
+    parser.add_argument('--scale', help="number of times the fixture events are repeated", type=int, nargs='+',
+                        default=[1, 10, 100])
+    parser.add_argument('--skip-linear', help="only measure the indexed implementation", action='store_true')
+    args = parser.parse_args()
+
+    trace_files = sorted(glob.glob(os.path.join(args.fixtures_dir, '**', '*.cpp.json'), recursive=True))
+    if not trace_files:
+        parser.error(f'no time-trace files in {args.fixtures_dir}')
+    fixture_events = load_region_events(trace_files)
+
+    print('| Scale | Events | Linear | Indexed | Speedup |')
+    print('| ----- | ------ | ------ | ------- | ------- |')
+    for scale in args.scale:
+        events = scale_events(fixture_events, scale)
+        indexed_result, indexed_time = measure(indexed_totals, events)
+        if args.skip_linear:
+            print(f'| {scale} | {len(events)} | - | {combine_traces.format_time(indexed_time * 1e6)} | - |')
+            continue
+        linear_result, linear_time = measure(linear_totals, events)
+        if linear_result != indexed_result:
+            raise RuntimeError(f'Results differ at scale {scale}: {linear_result} != {indexed_result}')
+        speedup = linear_time / indexed_time if indexed_time > 0 else float('inf')
+        print(f'| {scale} | {len(events)} | {combine_traces.format_time(linear_time * 1e6)} '
+              f'| {combine_traces.format_time(indexed_time * 1e6)} | {round(speedup, 1)}x |')
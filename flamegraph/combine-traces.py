@@ -11,12 +11,31 @@
 
 Run with (e.g.): python combine_traces.py foo.json bar.json.
 
+Compare the snapshots of two builds saved with --snapshot-output with (e.g.):
+python combine_traces.py diff before.db after.db.
+
 Adapted from: https://www.snsystems.com/technology/tech-blog/clang-time-trace-feature"""
 
 import argparse
+import bisect
+import collections
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
+import multiprocessing
 import os
 import re
+import shlex
+import sqlite3
+import sys
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Logging partial results
 verbose = False
@@ -37,6 +56,275 @@ def find_trace_files(directory):
     return trace_files
 
 
+# Characters that can continue a JSON number
+NUMBER_TAIL_REGEX = re.compile(r'[.eE+\-0-9]*')
+
+
+def iter_trace_events(filename, metadata=None, chunk_size=1 << 16):
+    """Incrementally parse the events in the traceEvents array of a time-trace file.
+
+    Events are yielded one at a time as they are decoded, so only the current
+    event and a small read buffer are kept in memory. Any other top-level
+    values in the file (e.g. beginningOfTime) are stored in `metadata`."""
+    decoder = json.JSONDecoder()
+    with open(filename, 'r') as f:
+        buffer = ''
+        pos = 0
+        eof = False
+
+        def fill(size=chunk_size):
+            nonlocal buffer, pos, eof
+            chunk = f.read(size)
+            if not chunk:
+                eof = True
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        def skip_whitespace():
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return
+                fill()
+
+        def expect(chars):
+            nonlocal pos
+            skip_whitespace()
+            if pos >= len(buffer) or buffer[pos] not in chars:
+                raise ValueError(f'{filename}: expected one of "{chars}" at offset {f.tell() - len(buffer) + pos}')
+            pos += 1
+            return buffer[pos - 1]
+
+        def decode_value():
+            nonlocal pos
+            skip_whitespace()
+            size = chunk_size
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    # A number followed only by number characters up to the end of
+                    # the buffer might be truncated, e.g. 1.5e10 split after 1.
+                    truncated = isinstance(value, (int, float)) and not isinstance(value, bool) and \
+                        NUMBER_TAIL_REGEX.fullmatch(buffer, end) is not None
+                    if not truncated or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill(size)
+                size *= 2
+
+        expect('{')
+        skip_whitespace()
+        if buffer.startswith('}', pos):
+            return
+        while True:
+            key = decode_value()
+            expect(':')
+            if key == 'traceEvents':
+                expect('[')
+                skip_whitespace()
+                if buffer.startswith(']', pos):
+                    pos += 1
+                else:
+                    while True:
+                        yield decode_value()
+                        if expect(',]') == ']':
+                            break
+            else:
+                value = decode_value()
+                if metadata is not None:
+                    metadata[key] = value
+            if expect(',}') == '}':
+                break
+
+
+# Extensions of the logs with the GCC -ftime-report or MSVC /d1reportTime
+# output of a translation unit
+TIME_REPORT_EXTENSIONS = ('.txt', '.log')
+
+# GCC phases in the frontend and the backend
+GCC_FRONTEND_PHASES = ['phase parsing', 'phase lang. deferred', 'phase late parsing cleanups']
+GCC_BACKEND_PHASES = ['phase opt and generate', 'phase last asm', 'phase finalize', 'phase stream in',
+                      'phase stream out']
+
+# GCC time variables of the GIMPLE and interprocedural optimizers. The rest
+# of the backend is counted as code generation.
+GCC_OPTIMIZER_PREFIXES = ('tree ', 'ipa ')
+
+GCC_TIME_REPORT_REGEX = re.compile(r'^\s*(\|?)\s*([^:|][^:]*?)\s*:\s*(\d+\.\d+.*)$')
+
+MSVC_SECTION_REGEX = re.compile(r'^\s*([A-Za-z][A-Za-z -]*):\s*$')
+
+MSVC_ENTRY_REGEX = re.compile(r'^(\s*)(.+?):\s*(\d+(?:\.\d+)?)s\s*$')
+
+MSVC_DLL_TIME_REGEX = re.compile(r'time\(.*?(c1xx|c1|c2)\.dll\)\s*=\s*(\d+(?:\.\d+)?)s', re.IGNORECASE)
+
+# Sections of the MSVC /d1reportTime output and the clang events they become
+MSVC_SECTION_EVENTS = {
+    'Include Headers': 'Source',
+    'Class Definitions': 'ParseClass',
+    'Function Definitions': 'ParseFunctionDefinition',
+}
+
+
+def is_time_report(trace_file):
+    return trace_file.endswith(TIME_REPORT_EXTENSIONS)
+
+
+def find_time_reports(directory):
+    time_reports = []
+    for root, _, files in os.walk(directory):
+        for file in files:
+            if is_time_report(file):
+                time_reports.append(os.path.join(root, file))
+    return time_reports
+
+
+def seconds_to_us(seconds):
+    return int(round(float(seconds) * 1000000))
+
+
+def complete_event(name, ts, dur, detail=None):
+    event = {'pid': 0, 'tid': 0, 'ph': 'X', 'ts': ts, 'dur': dur, 'name': name}
+    if detail is not None:
+        event['args'] = {'detail': detail}
+    return event
+
+
+def gcc_time_report_events(lines, filename):
+    """Convert the output of GCC -ftime-report into clang time-trace events.
+
+    GCC only reports how long each phase and time variable took, so the
+    events are laid out one after the other: the frontend with the parsing
+    time as a Source event followed by the template instantiations, and
+    then the backend with the optimizers followed by code generation.
+
+    The wall times of all reports in the log are added."""
+    phases = {}
+    items = {}
+    total = 0
+    for line in lines:
+        m = GCC_TIME_REPORT_REGEX.match(line)
+        if not m:
+            continue
+        [nested, name, values] = m.groups()
+        times = re.findall(r'\d+\.\d+', values)
+        if not times:
+            continue
+        # usr, sys and wall times, which older versions label explicitly
+        wall = seconds_to_us(times[2] if len(times) >= 3 else times[-1])
+        if name == 'TOTAL':
+            total += wall
+        elif name.startswith('phase '):
+            phases[name] = phases.get(name, 0) + wall
+        elif not nested:
+            items[name] = items.get(name, 0) + wall
+
+    frontend = sum(phases.get(phase, 0) for phase in GCC_FRONTEND_PHASES)
+    backend = sum(phases.get(phase, 0) for phase in GCC_BACKEND_PHASES)
+    parsing = phases.get('phase parsing', 0)
+    instantiations = min(items.get('template instantiation', 0), frontend - parsing)
+    optimizer = min(sum(dur for name, dur in items.items() if name.startswith(GCC_OPTIMIZER_PREFIXES)), backend)
+    total = max(total, frontend + backend)
+
+    events = [complete_event('ExecuteCompiler', 0, total)]
+    if frontend:
+        events.append(complete_event('Frontend', 0, frontend))
+    if parsing:
+        events.append(complete_event('Source', 0, parsing, filename))
+    if instantiations:
+        events.append(complete_event('PerformPendingInstantiations', parsing, instantiations))
+    if backend:
+        events.append(complete_event('Backend', frontend, backend))
+    if optimizer:
+        events.append(complete_event('Optimizer', frontend, optimizer))
+    if backend - optimizer:
+        events.append(complete_event('CodeGenPasses', frontend + optimizer, backend - optimizer))
+    return events
+
+
+def msvc_time_report_events(lines):
+    """Convert the output of MSVC /d1reportTime into clang time-trace events.
+
+    Included headers become nested Source events, following the indentation
+    of the include tree, and class and function definitions become Parse
+    events. The frontend and backend times come from the /Bt+ output if it
+    is also in the log."""
+    dll_times = {}
+    entries = []
+    section = None
+    for line in lines:
+        m = MSVC_DLL_TIME_REGEX.search(line)
+        if m:
+            dll = m.group(1).lower()
+            dll_times[dll] = dll_times.get(dll, 0) + seconds_to_us(m.group(2))
+            continue
+        m = MSVC_SECTION_REGEX.match(line)
+        if m:
+            section = MSVC_SECTION_EVENTS.get(m.group(1))
+            continue
+        m = MSVC_ENTRY_REGEX.match(line)
+        # The Count and Total lines summarize the entries of a section
+        if m and section is not None and m.group(2).strip() not in ('Count', 'Total'):
+            depth = len(m.group(1).expandtabs(4))
+            entries.append((section, depth, m.group(2).strip(), seconds_to_us(m.group(3))))
+
+    events = []
+    ts = 0
+    # Open events with their depth and end, and where their next child starts
+    stack = []
+    for [name, depth, detail, dur] in entries:
+        while stack and (stack[-1][0] >= depth or stack[-1][1] != name):
+            stack.pop()
+        if stack:
+            start = stack[-1][3]
+            dur = max(min(dur, stack[-1][2] - start), 0)
+            stack[-1][3] = start + dur
+        else:
+            start = ts
+            ts += dur
+        events.append(complete_event(name, start, dur, detail))
+        stack.append([depth, name, start + dur, start])
+
+    frontend = max(dll_times.get('c1xx', 0) + dll_times.get('c1', 0), ts)
+    backend = dll_times.get('c2', 0)
+    events.append(complete_event('ExecuteCompiler', 0, frontend + backend))
+    events.append(complete_event('Frontend', 0, frontend))
+    if backend:
+        events.append(complete_event('Backend', frontend, backend))
+    return events
+
+
+def is_msvc_time_report(lines):
+    for line in lines:
+        if MSVC_DLL_TIME_REGEX.search(line):
+            return True
+        m = MSVC_SECTION_REGEX.match(line)
+        if m and m.group(1) in MSVC_SECTION_EVENTS:
+            return True
+    return False
+
+
+def time_report_events(report_file, filename):
+    """Read the GCC or MSVC time report of a translation unit as clang time-trace events."""
+    with open(report_file, 'r', errors='replace') as f:
+        lines = f.read().splitlines()
+    if is_msvc_time_report(lines):
+        return msvc_time_report_events(lines)
+    return gcc_time_report_events(lines, filename)
+
+
+def trace_file_events(trace_file, filename):
+    """The events of a time-trace file, or of a time report converted to time-trace events."""
+    if is_time_report(trace_file):
+        return time_report_events(trace_file, filename)
+    return iter_trace_events(trace_file)
+
+
 def find_compile_commands(directory):
     current_dir = os.path.abspath(directory)
 
@@ -59,12 +347,230 @@ def load_compile_commands(directory):
         return json.load(f)
 
 
+def read_ninja_log(directory):
+    """Read the start and end times of the outputs built in the last ninja build.
+
+    Times are in microseconds since the build started. Ninja restarts its clock
+    for every build, so a new build starts whenever an entry ends before the
+    previous one."""
+    path = os.path.join(directory, '.ninja_log')
+    entries = {}
+    if not os.path.isfile(path):
+        return entries
+    with open(path, 'r') as f:
+        last_end = 0
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 4:
+                continue
+            start, end = int(fields[0]), int(fields[1])
+            if end < last_end:
+                entries = {}
+            last_end = end
+            entries[os.path.normpath(fields[3])] = (start * 1000, end * 1000)
+    return entries
+
+
+def read_trace_begin(trace_file):
+    """Get the beginningOfTime of a time-trace file, in microseconds since the epoch.
+
+    Clang writes this value after the trace events, so the end of the file is
+    searched first to avoid parsing the whole trace."""
+    with open(trace_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 4096))
+        m = re.search(rb'"beginningOfTime"\s*:\s*(\d+)', f.read())
+    if m:
+        return int(m.group(1))
+    metadata = {}
+    for _ in iter_trace_events(trace_file, metadata):
+        pass
+    return metadata.get('beginningOfTime')
+
+
+def ninja_critical_path(ninja_log):
+    """Estimate the critical path of a ninja build.
+
+    The ninja log doesn't record dependencies, so the path is reconstructed
+    from timing. Starting from the step that finished last, each step is
+    preceded by the step that finished most recently before it started,
+    which is the step it was most likely waiting for.
+
+    Returns the outputs on the critical path, in build order."""
+    steps = sorted(ninja_log.items(), key=lambda x: x[1][1])
+    ends = [end for [_, [_, end]] in steps]
+    path = []
+    i = len(steps) - 1
+    while i >= 0:
+        [output, [start, _]] = steps[i]
+        path.append(output)
+        i = bisect.bisect_right(ends, start, 0, i) - 1
+    path.reverse()
+    return path
+
+
+def ninja_wall_shares(ninja_log):
+    """Split the wall-clock time of a ninja build among its steps.
+
+    At each moment, the elapsed time is divided equally among the steps
+    running at that moment, so a step running alone gets all of it.
+
+    Returns the wall-clock share of each output, in microseconds."""
+    changes = sorted([(start, 1, output) for [output, [start, _]] in ninja_log.items()] +
+                     [(end, -1, output) for [output, [_, end]] in ninja_log.items()])
+    shares = dict.fromkeys(ninja_log, 0)
+    running = set()
+    last_ts = 0
+    for [ts, change, output] in changes:
+        if running and ts > last_ts:
+            share = (ts - last_ts) / len(running)
+            for running_output in running:
+                shares[running_output] += share
+        last_ts = ts
+        if change > 0:
+            running.add(output)
+        else:
+            running.discard(output)
+    return shares
+
+
+def trace_object_file(trace_file, build_dir, time_report_dir=None):
+    """Get the object file of a trace file, relative to the build directory.
+
+    Time reports are named after their object file, relative to the time
+    report directory, as in trace_display_name."""
+    if is_time_report(trace_file) and time_report_dir is not None:
+        return os.path.normpath(os.path.splitext(os.path.relpath(trace_file, time_report_dir))[0])
+    return os.path.normpath(os.path.relpath(trace_file[:-len('.json')] + '.o', build_dir))
+
+
+def find_trace_start_times(trace_files, build_dir, ninja_log, time_report_dir=None):
+    """Find when the compilation of each trace file started, in microseconds.
+
+    The times come from the ninja log of the build directory if it includes
+    every trace file. Otherwise, they come from the beginningOfTime of each trace.
+
+    Returns the start times and whether they come from the ninja log. Start
+    times from the ninja log refer to the first event in a trace, while the
+    beginningOfTime is the time all event timestamps are relative to."""
+    starts = {}
+    for trace_file in trace_files:
+        object_file = trace_object_file(trace_file, build_dir, time_report_dir)
+        if object_file not in ninja_log:
+            break
+        starts[trace_file] = ninja_log[object_file][0]
+    else:
+        return starts, True
+
+    starts = {}
+    for trace_file in trace_files:
+        begin = None if is_time_report(trace_file) else read_trace_begin(trace_file)
+        starts[trace_file] = begin if begin is not None else 0
+    return starts, False
+
+
+def compile_command_arguments(compile_command):
+    if 'arguments' in compile_command:
+        return compile_command['arguments']
+    try:
+        return shlex.split(compile_command['command'])
+    except ValueError:
+        return compile_command['command'].split()
+
+
+def compile_command_output(compile_command):
+    """Get the output file of a compile_commands.json entry, or None if unknown."""
+    if 'output' in compile_command:
+        return compile_command['output']
+    arguments = compile_command_arguments(compile_command)
+    for i, argument in enumerate(arguments):
+        if argument == '-o' and i + 1 < len(arguments):
+            return arguments[i + 1]
+        elif argument.startswith('-o') and len(argument) > 2:
+            return argument[2:]
+        elif argument.startswith('/Fo') and len(argument) > 3:
+            return argument[3:]
+    return None
+
+
+def index_compile_commands(compile_commands):
+    """Map the output file of each compile command to its source file.
+
+    Outputs are indexed both as written in the command and as absolute
+    paths, so object files can be looked up from the build directory
+    even if the compile commands were generated elsewhere."""
+    index = {}
+    for compile_command in compile_commands:
+        output = compile_command_output(compile_command)
+        if output is None:
+            continue
+        source_file = compile_command['file']
+        index.setdefault(os.path.normpath(output), source_file)
+        directory = compile_command.get('directory', '')
+        index.setdefault(os.path.normpath(os.path.join(directory, output)), source_file)
+    return index
+
+
 def is_subpath(child_path, parent_path):
     child_path = os.path.abspath(child_path)
     parent_path = os.path.abspath(parent_path)
     return child_path.startswith(parent_path + '/')
 
 
+class PathNormalizer:
+    """Make event detail paths relative to the source, build or include directories.
+
+    Include paths are de-duplicated into a trie of path components, and each
+    distinct detail string is resolved only once, so headers that appear in
+    many events don't touch the filesystem again."""
+
+    def __init__(self, source_dir, build_dir, include_paths):
+        self.source_dir = source_dir
+        self.build_dir = build_dir
+        self.cache = {}
+        # Each node maps path components to children. The None key marks the
+        # end of an include path and stores its position in `include_paths`,
+        # so the first matching include path still wins.
+        self.include_trie = {}
+        for priority, include_path in enumerate(include_paths):
+            include_path = os.path.abspath(include_path)
+            node = self.include_trie
+            for component in include_path.split('/')[1:]:
+                node = node.setdefault(component, {})
+            if None not in node:
+                node[None] = (priority, include_path)
+
+    def find_include_path(self, path):
+        match = None
+        node = self.include_trie
+        for component in path.split('/')[1:-1]:
+            node = node.get(component)
+            if node is None:
+                break
+            if None in node and (match is None or node[None][0] < match[0]):
+                match = node[None]
+        return None if match is None else match[1]
+
+    def __call__(self, detail):
+        if detail in self.cache:
+            return self.cache[detail]
+        path = detail
+        if os.path.exists(path):
+            path = os.path.abspath(path)
+            if is_subpath(path, self.source_dir):
+                path = os.path.relpath(path, self.source_dir)
+            elif is_subpath(path, self.build_dir):
+                path = os.path.relpath(path, self.build_dir)
+            else:
+                include_path = self.find_include_path(path)
+                if include_path is not None:
+                    path = os.path.relpath(path, include_path)
+        self.cache[detail] = path
+        return path
+
+
 def extract_include_paths(command):
     include_paths = []
 
@@ -98,12 +604,1319 @@ def format_time(microseconds):
         return f"{hours} h"
 
 
+# Tokens in the C++ names printed by clang: whitespace, scope operators,
+# identifiers, numbers, and any other single character
+SYMBOL_TOKEN_REGEX = re.compile(r'\s+|::|->|[A-Za-z_$][A-Za-z0-9_$]*|\d[A-Za-z0-9_.]*|.', re.DOTALL)
+
+SYMBOL_IDENTIFIER_REGEX = re.compile(r'[A-Za-z_$][A-Za-z0-9_$]*')
+
+# Operators that can follow the operator keyword, longest first
+SYMBOL_OPERATOR_REGEX = re.compile(
+    r'\s*(?:\(\)|\[\]|->\*|->|<=>|<<=|>>=|<<|>>|<=|>=|==|!=|&&|\|\||\+\+|--|[-+*/%^&|~!=<>,]=?|'
+    r'new\s*\[\]|delete\s*\[\]|new\b|delete\b|co_await\b|""\s*[A-Za-z_]\w*)')
+
+SYMBOL_GROUPINGS = ['primary', 'first-argument', 'namespace']
+
+# Names in the std and __gnu_cxx namespaces, or the namespaces themselves
+STD_SYMBOL_REGEX = re.compile(r'(?:::)?(?:std|__gnu_cxx)(?:::|$)')
+
+
+def symbol_operator_end(symbol, begin, depth):
+    # The operators with angle brackets are ambiguous when template arguments
+    # follow them: "operator<<<char>" is operator<< and "operator<<int>" is
+    # operator<. We take the longest operator after which the angle brackets
+    # remaining in the symbol close the templates we are in.
+    candidates = []
+    match = SYMBOL_OPERATOR_REGEX.match(symbol, begin)
+    while match:
+        candidates.append(match.end())
+        match = SYMBOL_OPERATOR_REGEX.match(symbol, begin, match.end() - 1)
+    for end in candidates:
+        rest = symbol[end:]
+        if rest.count('>') - rest.count('->') - rest.count('<') == depth:
+            return end
+    return candidates[0] if candidates else begin
+
+
+def tokenize_symbol(symbol):
+    """Split a C++ name into tokens.
+
+    Joining the tokens gives back the name. The operator keyword and its
+    operator are a single token, so operator<, operator>> and operator->
+    are not mistaken for angle brackets."""
+    if 'operator' not in symbol:
+        return SYMBOL_TOKEN_REGEX.findall(symbol)
+    tokens = []
+    depth = 0
+    i = 0
+    while i < len(symbol):
+        end = SYMBOL_TOKEN_REGEX.match(symbol, i).end()
+        token = symbol[i:end]
+        if token == 'operator':
+            end = symbol_operator_end(symbol, end, depth)
+            token = symbol[i:end]
+        elif token == '<':
+            depth += 1
+        elif token == '>' and depth:
+            depth -= 1
+        tokens.append(token)
+        i = end
+    return tokens
+
+
+def parse_symbol_sequence(tokens, i, nested):
+    # Template arguments are lists of sequences. A "<" in parentheses after a
+    # space is a comparison, since clang prints no space before template
+    # arguments.
+    items = []
+    parens = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if nested and parens == 0 and token in (',', '>'):
+            break
+        if token == '<' and not (parens and i > 0 and tokens[i - 1].isspace()):
+            arguments = []
+            i += 1
+            while True:
+                argument, i = parse_symbol_sequence(tokens, i, True)
+                arguments.append(argument)
+                if i >= len(tokens) or tokens[i] == '>':
+                    i += 1
+                    break
+                i += 1
+            items.append(arguments)
+            continue
+        if token == '(':
+            parens += 1
+        elif token == ')' and parens:
+            parens -= 1
+        items.append(token)
+        i += 1
+    return items, i
+
+
+def render_symbol_sequence(items, grouping):
+    output = []
+    for item in items:
+        if isinstance(item, str):
+            output.append(item)
+        elif grouping == 'first-argument':
+            first = render_symbol_sequence(item[0], 'primary').strip()
+            output.append(f'<{first}, $>' if len(item) > 1 else f'<{first}>')
+        else:
+            output.append('<$>')
+    return ''.join(output)
+
+
+def primary_symbol_group(tokens):
+    # The primary grouping in a single pass over the tokens, without building
+    # the parse tree. The same "<" are template arguments as in
+    # parse_symbol_sequence, with a count of parentheses for each template.
+    output = []
+    parens = 0
+    enclosing_parens = []
+    for i, token in enumerate(tokens):
+        if enclosing_parens and parens == 0 and token in (',', '>'):
+            if token == '>':
+                parens = enclosing_parens.pop()
+                if not enclosing_parens:
+                    output.append('<$>')
+            continue
+        if token == '<' and not (parens and i > 0 and tokens[i - 1].isspace()):
+            enclosing_parens.append(parens)
+            parens = 0
+            continue
+        if token == '(':
+            parens += 1
+        elif token == ')' and parens:
+            parens -= 1
+        if not enclosing_parens:
+            output.append(token)
+    if enclosing_parens:
+        output.append('<$>')
+    return ''.join(output)
+
+
+def symbol_scopes(items):
+    # Split the top-level items at the scope operators outside parentheses
+    scopes = [[]]
+    parens = 0
+    for item in items:
+        if item == '(':
+            parens += 1
+        elif item == ')' and parens:
+            parens -= 1
+        if item == '::' and parens == 0:
+            scopes.append([])
+        else:
+            scopes[-1].append(item)
+    return scopes
+
+
+def is_namespace_scope(scope):
+    if not all(isinstance(item, str) for item in scope):
+        return False
+    name = ''.join(scope)
+    return name == '(anonymous namespace)' or SYMBOL_IDENTIFIER_REGEX.fullmatch(name) is not None
+
+
+def parse_symbol(symbol):
+    """Parse a C++ name into a sequence of tokens and lists of template arguments."""
+    items, _ = parse_symbol_sequence(tokenize_symbol(symbol), 0, False)
+    return items
+
+
+def symbol_namespace(items):
+    """The leading scopes of a parsed C++ name that are plain names.
+
+    Classes cannot be told apart from namespaces in the name, so the
+    namespace of a member of a non-template class includes the class."""
+    scopes = symbol_scopes(items)
+    if scopes and not scopes[0]:
+        scopes = scopes[1:]
+    namespace = []
+    for scope in scopes[:-1]:
+        if not is_namespace_scope(scope):
+            break
+        namespace.append(''.join(scope))
+    return '::'.join(namespace)
+
+
+def group_symbol(symbol, grouping='primary'):
+    """The group of symbols a C++ name belongs to.
+
+    The grouping is 'primary' to replace the template arguments with $,
+    'first-argument' to keep the first template argument of the outermost
+    templates, or 'namespace' to group names by their namespace. The name
+    is tokenized and parsed once for any grouping."""
+    if grouping != 'namespace' and '<' not in symbol:
+        # Names without template arguments are their own group
+        return symbol
+    if grouping == 'primary':
+        return primary_symbol_group(tokenize_symbol(symbol))
+    items = parse_symbol(symbol)
+    if grouping == 'namespace':
+        return symbol_namespace(items) or '(global)'
+    return render_symbol_sequence(items, grouping)
+
+
+def is_std_symbol(symbol):
+    # Only the leading scope, up to the first ::, is checked
+    return STD_SYMBOL_REGEX.match(symbol) is not None
+
+
+class RegionSet:
+    """A set of half-open [start, end) time regions.
+
+    Overlapping and adjacent regions are merged as they are added, so the
+    regions are kept as disjoint sorted intervals and checking whether a
+    timestamp is covered by any region is a binary search."""
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def __contains__(self, ts):
+        i = bisect.bisect_right(self.starts, ts) - 1
+        return i >= 0 and ts < self.ends[i]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        # Regions that overlap or touch [start, end)
+        lo = bisect.bisect_left(self.ends, start)
+        hi = bisect.bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+
+
+# Kinds of events in the report tallies
+EVENT_COMPILE = 0
+EVENT_FRONTEND = 1
+EVENT_SOURCE = 2
+EVENT_PARSE = 3
+EVENT_INSTANTIATE = 4
+EVENT_PENDING_INSTANTIATIONS = 5
+EVENT_BACKEND = 6
+EVENT_CODEGEN = 7
+EVENT_OPTIMIZE = 8
+EVENT_KINDS = 9
+
+# Events that only count towards the totals
+TOTAL_EVENT_KINDS = {
+    'Frontend': EVENT_FRONTEND,
+    'Backend': EVENT_BACKEND,
+    'Optimizer': EVENT_OPTIMIZE,
+    'CodeGenPasses': EVENT_CODEGEN,
+}
+
+
+# Fields of the trace events that are written to the combined trace
+EMITTED_EVENT_FIELDS = frozenset(['pid', 'tid', 'name', 'cat', 'ph', 'ts', 'dur', 'id', 'args'])
+
+
+class EventColumns:
+    """Columnar store of the events of a trace, used to compute the report tallies.
+
+    Each event is a row with its kind, the id of its interned detail, its
+    timestamp, its duration and whether it counts towards the total of its
+    kind. Rows are stored in arrays of integers, which are the only copy of
+    the events kept for the report, so all the totals and tallies are
+    computed in a single pass over the columns, with NumPy if it is available."""
+
+    def __init__(self):
+        self.kind = array('q')
+        self.detail = array('q')
+        self.ts = array('q')
+        self.dur = array('q')
+        self.counted = array('b')
+        # Interned details of each kind of event, in the order they first appear
+        self.details = [{} for _ in range(EVENT_KINDS)]
+
+    def __len__(self):
+        return len(self.kind)
+
+    def append(self, kind, detail, ts, dur):
+        detail_id = -1
+        if detail is not None:
+            ids = self.details[kind]
+            detail_id = ids.get(detail)
+            if detail_id is None:
+                detail_id = len(ids)
+                ids[detail] = detail_id
+        self.kind.append(kind)
+        self.detail.append(detail_id)
+        self.ts.append(ts)
+        self.dur.append(dur)
+        self.counted.append(1)
+
+    def count_regions(self):
+        """Count nested parsing and instantiation regions only once in the totals.
+
+        Events are visited from the longest to the shortest, so an event is
+        not counted if it starts inside a region that was already counted.
+        PerformPendingInstantiations regions contain instantiations, but are
+        always counted themselves."""
+        parsing_regions = RegionSet()
+        instantiation_regions = RegionSet()
+        rows = [i for i, k in enumerate(self.kind)
+                if k == EVENT_SOURCE or k == EVENT_INSTANTIATE or k == EVENT_PENDING_INSTANTIATIONS]
+        rows.sort(key=self.dur.__getitem__, reverse=True)
+        for i in rows:
+            kind = self.kind[i]
+            ts = self.ts[i]
+            end = ts + self.dur[i]
+            if kind == EVENT_PENDING_INSTANTIATIONS:
+                instantiation_regions.add(ts, end)
+                continue
+            regions = parsing_regions if kind == EVENT_SOURCE else instantiation_regions
+            if ts in regions:
+                self.counted[i] = 0
+            else:
+                regions.add(ts, end)
+
+    def summarize(self):
+        """Get the totals of each kind of event and the tallies of their details in one pass over the rows.
+
+        Totals are [count, duration, counted count, counted duration] lists
+        indexed by kind, and tallies map the details of each kind to
+        (count, duration) tuples."""
+        self.count_regions()
+        sizes = [len(names) for names in self.details]
+        offsets = [sum(sizes[:kind]) for kind in range(EVENT_KINDS)]
+        if numpy is not None:
+            kinds = numpy.frombuffer(self.kind, dtype=numpy.int64)
+            ids = numpy.frombuffer(self.detail, dtype=numpy.int64)
+            durs = numpy.frombuffer(self.dur, dtype=numpy.int64)
+            counted = numpy.frombuffer(self.counted, dtype=numpy.int8) != 0
+            # Sums of durations are exact in float64 below 2^53 microseconds
+            totals = [list(row) for row in zip(
+                numpy.bincount(kinds, minlength=EVENT_KINDS).tolist(),
+                numpy.bincount(kinds, weights=durs, minlength=EVENT_KINDS).astype(numpy.int64).tolist(),
+                numpy.bincount(kinds[counted], minlength=EVENT_KINDS).tolist(),
+                numpy.bincount(kinds[counted], weights=durs[counted], minlength=EVENT_KINDS)
+                .astype(numpy.int64).tolist())]
+            has_detail = ids >= 0
+            keys = numpy.array(offsets, dtype=numpy.int64)[kinds[has_detail]] + ids[has_detail]
+            counts = numpy.bincount(keys, minlength=sum(sizes)).tolist()
+            sums = numpy.bincount(keys, weights=durs[has_detail], minlength=sum(sizes)).astype(numpy.int64).tolist()
+        else:
+            totals = [[0, 0, 0, 0] for _ in range(EVENT_KINDS)]
+            counts = [0] * sum(sizes)
+            sums = [0] * sum(sizes)
+            for [k, i, d, c] in zip(self.kind, self.detail, self.dur, self.counted):
+                total = totals[k]
+                total[0] += 1
+                total[1] += d
+                if c:
+                    total[2] += 1
+                    total[3] += d
+                if i >= 0:
+                    j = offsets[k] + i
+                    counts[j] += 1
+                    sums[j] += d
+        tallies = [{name: (counts[offsets[kind] + i], sums[offsets[kind] + i]) for name, i in names.items()}
+                   for kind, names in enumerate(self.details)]
+        return totals, tallies
+
+    def include_tree(self, filename):
+        """Get the exclusive time of each header and the include edges from the nesting of the Source events.
+
+        Headers included at the top level are included by the file itself.
+        Returns the header_exclusive and include_edges tallies."""
+        names = list(self.details[EVENT_SOURCE])
+        rows = [i for i, k in enumerate(self.kind) if k == EVENT_SOURCE]
+        rows.sort(key=lambda i: (self.ts[i], -self.dur[i]))
+        exclusive = {}
+        edges = {}
+        includers = []
+        for i in rows:
+            ts = self.ts[i]
+            dur = self.dur[i]
+            while includers and ts >= includers[-1][1]:
+                includers.pop()
+            header = names[self.detail[i]]
+            # Time reports have a Source event for the file itself
+            if header == filename:
+                continue
+            includer = includers[-1][0] if includers else filename
+            edge = edges.setdefault(include_edge_key(includer, header), [0, 0])
+            edge[0] += 1
+            edge[1] += dur
+            exclusive[header] = exclusive.get(header, 0) + dur
+            if includers:
+                exclusive[includer] -= dur
+            includers.append((header, ts + dur))
+        header_exclusive = {header: (1, dur) for header, dur in exclusive.items()}
+        include_edges = {edge: (count, dur) for edge, [count, dur] in edges.items()}
+        return header_exclusive, include_edges
+
+    def instantiation_tree(self):
+        """Get the exclusive time of each instantiated symbol from the nesting of the Instantiate events.
+
+        The time of an instantiation excludes the instantiations nested in it,
+        so the times of all symbols add up to the time spent instantiating.
+        Returns the symbol_instantiate_exclusive tally."""
+        names = list(self.details[EVENT_INSTANTIATE])
+        rows = [i for i, k in enumerate(self.kind) if k == EVENT_INSTANTIATE]
+        rows.sort(key=lambda i: (self.ts[i], -self.dur[i]))
+        exclusive = {}
+        parents = []
+        for i in rows:
+            ts = self.ts[i]
+            dur = self.dur[i]
+            while parents and ts >= parents[-1][1]:
+                parents.pop()
+            symbol = names[self.detail[i]]
+            entry = exclusive.setdefault(symbol, [0, 0])
+            entry[0] += 1
+            entry[1] += dur
+            if parents:
+                # Only the part of the event inside its parent is nested in it
+                parent_symbol, parent_end = parents[-1]
+                exclusive[parent_symbol][1] -= min(dur, parent_end - ts)
+                dur = min(dur, parent_end - ts)
+            parents.append((symbol, ts + dur))
+        return {symbol: (count, dur) for symbol, [count, dur] in exclusive.items()}
+
+
+class TraceEventWriter:
+    """Write the combined trace events to a file as they are produced.
+
+    Events are written in timestamp order with a compact encoding. The events
+    of each trace file are only kept until the events of the next file are
+    added, since earlier events can't come after them in the timeline.
+
+    Paths ending with ".gz" are compressed with gzip. Without a path, the
+    events are discarded."""
+
+    def __init__(self, path):
+        self.pending = []
+        self.last_ts = None
+        self.count = 0
+        if path is None:
+            self.file = None
+            return
+        if path.endswith('.gz'):
+            self.file = gzip.open(path, 'wt', encoding='utf-8')
+        else:
+            self.file = open(path, 'w')
+        self.encoder = json.JSONEncoder(separators=(',', ':'))
+        self.file.write('{"traceEvents":[')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_unsorted(self, events):
+        """Write events whose position in the file doesn't matter, such as metadata events."""
+        if self.file is None:
+            return
+        for event in events:
+            if self.count != 0:
+                self.file.write(',')
+            self.file.write(self.encoder.encode(event))
+            self.count += 1
+
+    def add(self, events):
+        """Add the events of a trace file, already offset to their place in the timeline."""
+        if self.file is None:
+            return
+        events = sorted(events, key=lambda k: k['ts'])
+        if not events:
+            return
+        if self.last_ts is not None and events[0]['ts'] < self.last_ts:
+            log(f'Events at {events[0]["ts"]} are written after events at {self.last_ts}')
+        # Events up to the start of this file can't be preceded by any of its events
+        self.flush(events[0]['ts'])
+        self.pending.append(events)
+
+    def flush(self, until=None):
+        """Write the pending events up to the `until` timestamp, or all of them."""
+        merged = heapq.merge(*self.pending, key=lambda k: k['ts'])
+        remaining = []
+        for event in merged:
+            if until is not None and event['ts'] > until:
+                remaining.append(event)
+                remaining.extend(merged)
+                break
+            if self.count != 0:
+                self.file.write(',')
+            self.file.write(self.encoder.encode(event))
+            self.last_ts = event['ts']
+            self.count += 1
+        self.pending = [remaining] if remaining else []
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        self.file.write(']}')
+        self.file.close()
+        self.file = None
+
+
+def lane_events(lane_intervals):
+    """Create metadata and counter events describing the lanes of a real timeline.
+
+    Each lane is named after its index, and a counter track shows how many
+    files were being compiled in parallel at each point in time."""
+    events = []
+    lanes = sorted({lane for [_, _, lane] in lane_intervals})
+    for lane in lanes:
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': lane, 'args': {'name': f'Lane {lane}'}})
+        events.append({'name': 'thread_sort_index', 'ph': 'M', 'pid': 0, 'tid': lane, 'args': {'sort_index': lane}})
+    changes = sorted([(start, 1) for [start, _, _] in lane_intervals] +
+                     [(end, -1) for [_, end, _] in lane_intervals])
+    parallel = 0
+    for i, [ts, change] in enumerate(changes):
+        parallel += change
+        if i + 1 == len(changes) or changes[i + 1][0] != ts:
+            events.append({'name': 'Parallel compilations', 'ph': 'C', 'pid': 0, 'ts': ts,
+                           'args': {'files': parallel}})
+    return events
+
+
+def add_scaled_tally(tally, partial, factor):
+    """Add the durations in `partial` to `tally` scaled by `factor`, counting one file for each entry."""
+    for name, [_, dur] in partial.items():
+        if name not in tally:
+            tally[name] = (0, 0)
+        tally[name] = (tally[name][0] + 1, tally[name][1] + dur * factor)
+
+
+def fold_stacks(events):
+    """Exclusive time of each stack of nested events, as in folded stack files.
+
+    Nesting is reconstructed from the timestamps and durations of the
+    complete events of each thread. Stacks are keyed by the event names
+    joined with ';' and map to (count, exclusive duration) tuples."""
+    threads = {}
+    for event in events:
+        if event.get('ph') == 'X' and event.get('dur'):
+            threads.setdefault(event.get('tid'), []).append(event)
+
+    stacks = {}
+
+    def save_stack(names, self_time):
+        stack = ';'.join(names)
+        count, dur = stacks.get(stack, (0, 0))
+        stacks[stack] = (count + 1, dur + max(self_time, 0))
+
+    for thread_events in threads.values():
+        thread_events.sort(key=lambda x: (int(x['ts']), -int(x['dur'])))
+        names = []
+        ends = []
+        self_times = []
+        for event in thread_events:
+            ts = int(event['ts'])
+            dur = int(event['dur'])
+            while ends and ends[-1] <= ts:
+                save_stack(names, self_times.pop())
+                names.pop()
+                ends.pop()
+            if self_times:
+                self_times[-1] -= dur
+            names.append(event['name'].replace(';', ':').replace('\n', ' '))
+            ends.append(ts + dur)
+            self_times.append(dur)
+        while ends:
+            save_stack(names, self_times.pop())
+            names.pop()
+            ends.pop()
+    return stacks
+
+
+def write_folded_stacks(path, stacks):
+    """Save stacks as 'a;b;c <us>' lines, the input of flamegraph.pl and the flamegraph action."""
+    with open(path, 'w') as f:
+        for stack in sorted(stacks):
+            dur = stacks[stack][1]
+            if dur > 0:
+                f.write(f'{stack} {float(dur)}\n')
+
+
+def include_edge_key(includer, header):
+    return f'{includer}\n{header}'
+
+
+def include_graph(include_edges):
+    """Get the headers included by each file and the files including each header."""
+    children = {}
+    parents = {}
+    for edge in include_edges:
+        [includer, header] = edge.split('\n', 1)
+        children.setdefault(includer, set()).add(header)
+        parents.setdefault(header, set()).add(includer)
+    return children, parents
+
+
+def reachable(children, starts, removed=None):
+    """Get the nodes reachable from `starts` in the include graph, optionally without going through `removed`."""
+    visited = set()
+    pending = [start for start in starts if start != removed]
+    while pending:
+        node = pending.pop()
+        if node in visited:
+            continue
+        visited.add(node)
+        pending.extend(child for child in children.get(node, ()) if child != removed and child not in visited)
+    return visited
+
+
+def include_costs(file_parse, header_exclusive, include_edges, max_headers=100):
+    """Estimate the cost of the most expensive headers in the inclusion graph.
+
+    The include edges of all files are merged into a single graph whose roots
+    are the compiled files. For each header, this estimates the time saved if
+    it were no longer included, which is its exclusive time plus the exclusive
+    time of the headers that are only reachable through it. It also estimates
+    the time saved by moving the header into a precompiled header, where it
+    would be parsed once rather than once per file.
+
+    Returns a list of (header, inclusive, exclusive, files, includers, if removed,
+    precompiled savings) tuples for the headers with the largest inclusive time."""
+    [children, parents] = include_graph(include_edges)
+    roots = [node for node in children if node not in parents]
+
+    costs = []
+    headers = sorted(header_exclusive, key=lambda h: file_parse.get(h, (0, 0))[1], reverse=True)
+    for header in headers[:max_headers]:
+        [files, exclusive] = header_exclusive[header]
+        [_, inclusive] = file_parse.get(header, (0, 0))
+        # Headers that are no longer reachable without this one
+        dominated = reachable(children, [header]) - reachable(children, roots, removed=header)
+        if_removed = sum(header_exclusive[h][1] for h in dominated if h in header_exclusive)
+        precompiled = inclusive - inclusive / files if files else 0
+        costs.append((header, inclusive, exclusive, files, len(parents.get(header, ())), if_removed, precompiled))
+    return costs
+
+
+def find_header_file(header, search_dirs):
+    """Find the file for a header name as it appears in the report, or None if it can't be found."""
+    if os.path.isabs(header):
+        return header if os.path.isfile(header) else None
+    for search_dir in search_dirs:
+        path = os.path.join(search_dir, header)
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+    return None
+
+
+def header_include_spelling(path, include_dirs):
+    """Get the #include argument for a header file, such as <boost/config.hpp>.
+
+    Headers from a standard library installation (.../include/c++/<version>/...)
+    and headers in an include directory use angle brackets. Other headers are
+    included with their absolute path in quotes."""
+    m = re.match(r'.*/include/c\+\+/[^/]+/(.*)$', path)
+    if m:
+        return f'<{m.group(1)}>'
+    best = None
+    for include_dir in include_dirs:
+        if is_subpath(path, include_dir):
+            relative = os.path.relpath(path, include_dir)
+            if best is None or len(relative) < len(best):
+                best = relative
+    if best is not None:
+        return f'<{best}>'
+    return f'"{path}"'
+
+
+def select_precompiled_headers(file_parse, header_exclusive, include_edges, search_dirs, include_dirs,
+                               budget, max_candidates=200):
+    """Greedily choose the headers to include in a precompiled header.
+
+    Candidates are the headers parsed by at least two files, scored by their
+    total inclusive parse time, that is, their average parse time multiplied
+    by the number of files including them. Headers are picked in order of
+    score per byte while the total size of the headers and the headers they
+    include stays under `budget` bytes. Headers already included by a chosen
+    header are skipped, and so are implementation details such as detail/ and
+    bits/ headers.
+
+    Returns a list of (header, spelling, score, estimated savings, size) tuples."""
+    [children, _] = include_graph(include_edges)
+    sizes = {}
+
+    def header_size(header):
+        if header not in sizes:
+            path = find_header_file(header, search_dirs)
+            sizes[header] = os.path.getsize(path) if path is not None else None
+        return sizes[header]
+
+    candidates = []
+    for header, [files, _] in header_exclusive.items():
+        if files < 2 or header not in file_parse:
+            continue
+        path = find_header_file(header, search_dirs)
+        if path is None:
+            continue
+        spelling = header_include_spelling(path, include_dirs)
+        if '/detail/' in spelling or spelling.startswith('<bits/') or '/bits/' in spelling:
+            continue
+        candidates.append((header, spelling, file_parse[header][1], files))
+    candidates = sorted(candidates, key=lambda x: x[2], reverse=True)[:max_candidates]
+
+    def closure_size(header, covered):
+        return sum(header_size(h) or 0 for h in reachable(children, [header]) if h not in covered)
+
+    candidates.sort(key=lambda x: x[2] / max(closure_size(x[0], set()), 1), reverse=True)
+    selected = []
+    covered = set()
+    total_size = 0
+    for [header, spelling, score, files] in candidates:
+        if header in covered:
+            continue
+        size = closure_size(header, covered)
+        if total_size + size > budget:
+            continue
+        total_size += size
+        included = reachable(children, [header])
+        covered.update(included)
+        # Headers chosen before are redundant if this header includes them
+        selected = [entry for entry in selected if entry[0] not in included]
+        selected.append((header, spelling, score, score - score / files, size))
+    return selected
+
+
+def new_aggregates():
+    """Create empty report tallies.
+
+    Totals are (count, duration) tuples and individual files and
+    symbols map their names to (count, duration) tuples.
+
+    The exclusive parse time of headers is counted once per file including
+    them, and include edges are keyed by include_edge_key. The exclusive
+    instantiation time of symbols excludes the instantiations nested in them. Folded stacks
+    are only collected when requested."""
+    return {
+        'total_compile': (0, 0),
+        'total_frontend': (0, 0),
+        'total_parsing': (0, 0),
+        'total_instantiations': (0, 0),
+        'total_backend': (0, 0),
+        'total_codegen': (0, 0),
+        'total_optimize': (0, 0),
+        'file_compile': {},
+        'file_parse': {},
+        'symbol_parse': {},
+        'symbol_instantiate': {},
+        'symbol_instantiate_exclusive': {},
+        'header_exclusive': {},
+        'include_edges': {},
+        'total_pruned': (0, 0),
+        'folded_stacks': {},
+    }
+
+
+def merge_aggregates(aggregates, partial):
+    """Add the tallies in `partial` to `aggregates`."""
+    for key, value in partial.items():
+        if isinstance(value, dict):
+            tally = aggregates[key]
+            for name, [count, dur] in value.items():
+                if name not in tally:
+                    tally[name] = (0, 0)
+                tally[name] = (tally[name][0] + count, tally[name][1] + dur)
+        else:
+            aggregates[key] = (aggregates[key][0] + value[0], aggregates[key][1] + value[1])
+
+
+SNAPSHOT_VERSION = 1
+
+SNAPSHOT_TOTALS = ['total_compile', 'total_frontend', 'total_parsing', 'total_instantiations', 'total_backend',
+                   'total_codegen', 'total_optimize']
+
+SNAPSHOT_TALLIES = ['file_compile', 'file_parse', 'symbol_parse', 'symbol_instantiate']
+
+
+def write_snapshot(path, aggregates):
+    """Save the totals and the file and symbol tallies in a SQLite file.
+
+    Names are stored once in the strings table, and each (count, total_us)
+    tally refers to the string ids of its kind and name."""
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute('CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)')
+        connection.execute('CREATE TABLE strings (id INTEGER PRIMARY KEY, value TEXT NOT NULL)')
+        connection.execute('CREATE TABLE tallies (kind INTEGER, name INTEGER, count INTEGER, total_us INTEGER)')
+        connection.execute('INSERT INTO metadata VALUES (?, ?)', ('version', str(SNAPSHOT_VERSION)))
+        strings = {}
+
+        def intern(value):
+            if value not in strings:
+                strings[value] = len(strings)
+            return strings[value]
+
+        rows = []
+        for key in SNAPSHOT_TOTALS:
+            count, dur = aggregates[key]
+            rows.append((intern('total'), intern(key[len('total_'):]), count, int(round(dur))))
+        for key in SNAPSHOT_TALLIES:
+            kind = intern(key)
+            for name, [count, dur] in aggregates[key].items():
+                rows.append((kind, intern(name), count, int(round(dur))))
+        connection.executemany('INSERT INTO strings VALUES (?, ?)', ((i, value) for value, i in strings.items()))
+        connection.executemany('INSERT INTO tallies VALUES (?, ?, ?, ?)', rows)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def read_snapshot(path):
+    """Load the tallies saved by write_snapshot as aggregates."""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'Snapshot {path} not found')
+    connection = sqlite3.connect(path)
+    try:
+        [version] = connection.execute("SELECT value FROM metadata WHERE key = 'version'").fetchone()
+        if int(version) != SNAPSHOT_VERSION:
+            raise ValueError(f'Snapshot {path} has version {version} instead of {SNAPSHOT_VERSION}')
+        strings = dict(connection.execute('SELECT id, value FROM strings'))
+        aggregates = {key: (0, 0) for key in SNAPSHOT_TOTALS}
+        aggregates.update({key: {} for key in SNAPSHOT_TALLIES})
+        for kind, name, count, total_us in connection.execute('SELECT kind, name, count, total_us FROM tallies'):
+            if strings[kind] == 'total':
+                aggregates['total_' + strings[name]] = (count, total_us)
+            else:
+                aggregates[strings[kind]][strings[name]] = (count, total_us)
+        return aggregates
+    finally:
+        connection.close()
+
+
+def format_milliseconds(microseconds):
+    return f'{round(microseconds / 1000, 2)} ms'
+
+
+def diff_snapshots(before, after, top=20, threshold_ms=10):
+    """Compare two snapshots and return a Markdown report and the number of regressions.
+
+    Tallies whose total time grows by more than `threshold_ms` are
+    flagged as regressions. Each section lists the `top` largest increases."""
+    output = '# Time-Trace Diff\n\n'
+    regressions = 0
+
+    def diff_table(column_name, rows):
+        nonlocal regressions
+        rows = sorted(rows, key=lambda row: row[2] - row[1], reverse=True)[:top]
+        table = f'| {column_name} | Before | After | Change | Change % | Regression |\n'
+        table += f'| {"-" * len(column_name)} | ------ | ----- | ------ | -------- | ---------- |\n'
+        for [name, before_time, after_time] in rows:
+            change = after_time - before_time
+            change_percent = f'{round(change / before_time * 100, 2)}%' if before_time else '-'
+            is_regression = change > threshold_ms * 1000
+            if is_regression:
+                regressions += 1
+            table += f'| `{name}` | {format_milliseconds(before_time)} | {format_milliseconds(after_time)} '
+            table += f'| {"+" if change > 0 else ""}{format_milliseconds(change)} | {change_percent} '
+            table += f'| {"**yes**" if is_regression else ""} |\n'
+        return table + '\n\n'
+
+    output += '## Summary\n\n'
+    output += diff_table('Total', [(key[len('total_'):].capitalize(), before[key][1], after[key][1])
+                                   for key in SNAPSHOT_TOTALS])
+
+    for key, title, column_name in [('file_compile', 'Files: Compile', 'File'),
+                                    ('file_parse', 'Files: Parse', 'File'),
+                                    ('symbol_parse', 'Symbols: Parse', 'Symbol'),
+                                    ('symbol_instantiate', 'Symbols: Instantiate', 'Symbol')]:
+        names = set(before[key]) | set(after[key])
+        rows = [(name, before[key].get(name, (0, 0))[1], after[key].get(name, (0, 0))[1]) for name in names]
+        output += f'## {title}\n\n'
+        output += diff_table(column_name, rows)
+    return output, regressions
+
+
+def diff_main(argv):
+    parser = argparse.ArgumentParser(prog='combine-traces.py diff',
+                                     description='Compare two snapshots saved with --snapshot-output.')
+    parser.add_argument('before', help="snapshot of the baseline build")
+    parser.add_argument('after', help="snapshot of the new build")
+    parser.add_argument('--top', type=int, default=20, help="number of largest changes listed in each section")
+    parser.add_argument('--threshold-ms', type=float, default=10,
+                        help="flag tallies whose time grows by more than this as regressions")
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help="exit with an error code if there are regressions")
+    parser.add_argument('-o', '--output', help="output file (printed to stdout by default)")
+    args = parser.parse_args(argv)
+
+    output, regressions = diff_snapshots(read_snapshot(args.before), read_snapshot(args.after), args.top,
+                                         args.threshold_ms)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+def trace_display_name(trace_file, context):
+    """Get a nicer filename for a trace file, for display in the combined trace and report."""
+    source_dir = context['source_dir']
+    build_dir = context['build_dir']
+    compile_commands_index = context['compile_commands_index']
+    if is_time_report(trace_file):
+        # Time reports are named after their object or source file
+        filename = os.path.splitext(os.path.relpath(trace_file, context['time_report_dir']))[0]
+        object_file = os.path.join(build_dir, filename)
+    else:
+        filename = os.path.relpath(trace_file, build_dir)
+        filename = filename[:-5]
+        object_file = trace_file[:-len('.json')] + '.o'
+    source_file = compile_commands_index.get(os.path.normpath(object_file))
+    if source_file is None:
+        source_file = compile_commands_index.get(os.path.normpath(os.path.relpath(object_file, build_dir)))
+    if source_file is not None:
+        filename = os.path.relpath(source_file, source_dir)
+    filename = filename.replace('CMakeFiles/', '')
+    segments = filename.split('/')
+    segments = [f'{{{segment[:-4]}}}' if segment.endswith('.dir') else segment for segment in segments]
+    filename = '/'.join(segments)
+    if filename.find('../') != -1:
+        filename = os.path.abspath(filename)
+    return filename
+
+
+def trace_events_to_emit(trace_file, filename, context):
+    """Stream the events of a trace file as they are written to the combined trace.
+
+    Only the fields written to the combined trace are kept, details are
+    normalized, Source events are named after their file, and the
+    ExecuteCompiler event records the display filename.
+
+    Yields the original name of each event and the event to emit."""
+    normalize_path = context['normalize_path']
+    for event in trace_file_events(trace_file, filename):
+        name = event['name']
+        # Metadata and totals are not emitted
+        if event['ph'] == 'M' or name.startswith('Total'):
+            continue
+        event = {field: value for field, value in event.items() if field in EMITTED_EVENT_FIELDS}
+        args = event.get('args')
+        if args is not None and type(args.get('detail')) == str:
+            args['detail'] = normalize_path(args['detail'])
+        if name == 'Source':
+            event['name'] = filename if args is None or 'detail' not in args else args['detail']
+            event['cat'] = 'Source'
+        elif name == 'ExecuteCompiler':
+            if args is None:
+                event['args'] = {}
+            event['args']['detail'] = filename
+        yield name, event
+
+
+def event_duration(event):
+    return 0 if 'dur' not in event else int(event['dur'])
+
+
+def load_trace_events(trace_file, filename, context):
+    """Read the events of a trace file to emit, in the order process_trace returns them."""
+    events = [event for _, event in trace_events_to_emit(trace_file, filename, context)]
+    events.sort(key=event_duration, reverse=True)
+    return events
+
+
+def process_trace(trace_file, context):
+    """Parse, normalize and aggregate the events of a single time-trace file or time report.
+
+    Events are only kept when the combined trace or the folded stacks need
+    them. They are returned with their original timestamps, so the caller
+    can assign each file its place in the combined timeline.
+
+    Returns a tuple with the display filename, the events to emit, the total
+    compile time of the file, the timestamp of its first event, and the
+    partial aggregates for the report."""
+    # Adjust filename
+    filename = trace_display_name(trace_file, context)
+    keep_events = context.get('emit_events', True) or context.get('folded_stacks')
+
+    events = []
+    first_ts = None
+    file_total_time = 0
+    # Report data
+    columns = EventColumns()
+    for name, event in trace_events_to_emit(trace_file, filename, context):
+        if keep_events:
+            events.append(event)
+        ts = event['ts']
+        if first_ts is None or ts < first_ts:
+            first_ts = ts
+        args = event.get('args')
+        detail = None if args is None else args.get('detail')
+
+        # Store data for the report
+        if name == 'Source':
+            columns.append(EVENT_SOURCE, detail, int(ts), int(event['dur']))
+
+        elif name.startswith('Parse') and detail is not None:
+            columns.append(EVENT_PARSE, detail, int(ts), int(event['dur']))
+
+        elif name.startswith('Instantiate') and detail is not None:
+            columns.append(EVENT_INSTANTIATE, detail, int(ts), int(event['dur']))
+
+        elif name == 'PerformPendingInstantiations':
+            columns.append(EVENT_PENDING_INSTANTIATIONS, None, int(ts), int(event['dur']))
+
+        elif name in TOTAL_EVENT_KINDS:
+            columns.append(TOTAL_EVENT_KINDS[name], None, int(ts), int(event['dur']))
+
+        elif name == 'ExecuteCompiler':
+            columns.append(EVENT_COMPILE, filename, int(ts), int(event['dur']))
+            # The main ExecuteCompiler event, which exists for each file,
+            # represents how long the whole object file took and can be
+            # used to shift the start time for the next file
+            if file_total_time == 0 or event['dur'] <= file_total_time:
+                file_total_time = event['dur']
+    log(f'{filename}: {len(columns)} events loaded')
+    log(f'{filename} took {format_time(file_total_time)}')
+
+    # Longer events first, so parents come before children that start at the same time
+    events.sort(key=event_duration, reverse=True)
+
+    [totals, tallies] = columns.summarize()
+    [header_exclusive, include_edges] = columns.include_tree(filename)
+    symbol_instantiate_exclusive = columns.instantiation_tree()
+    del columns
+    total_instantiations = totals[EVENT_INSTANTIATE]
+    pending_instantiations = totals[EVENT_PENDING_INSTANTIATIONS]
+    aggregates = {
+        'total_compile': tuple(totals[EVENT_COMPILE][:2]),
+        'total_frontend': tuple(totals[EVENT_FRONTEND][:2]),
+        'total_parsing': tuple(totals[EVENT_SOURCE][2:]),
+        'total_instantiations': (total_instantiations[2] + pending_instantiations[0],
+                                 total_instantiations[3] + pending_instantiations[1]),
+        'total_backend': tuple(totals[EVENT_BACKEND][:2]),
+        'total_codegen': tuple(totals[EVENT_CODEGEN][:2]),
+        'total_optimize': tuple(totals[EVENT_OPTIMIZE][:2]),
+        'file_compile': tallies[EVENT_COMPILE],
+        'file_parse': tallies[EVENT_SOURCE],
+        'symbol_parse': tallies[EVENT_PARSE],
+        'symbol_instantiate': tallies[EVENT_INSTANTIATE],
+        'symbol_instantiate_exclusive': symbol_instantiate_exclusive,
+        'header_exclusive': header_exclusive,
+        'include_edges': include_edges,
+    }
+    if context.get('folded_stacks'):
+        aggregates['folded_stacks'] = fold_stacks(events)
+    if not context.get('emit_events', True):
+        events = []
+    return filename, events, file_total_time, first_ts or 0, aggregates
+
+
+# Version of the trace cache entries
+# This should be increased whenever process_trace changes its results
+TRACE_CACHE_VERSION = 8
+
+
+def trace_cache_fingerprint(source_dir, build_dir, include_paths, folded_stacks=False):
+    """Identify the settings that affect the results of process_trace.
+
+    Cache entries created with different settings are not reused."""
+    data = json.dumps([TRACE_CACHE_VERSION, source_dir, build_dir, include_paths, folded_stacks])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+# Names of the cache entries, which are the sha1 of the trace path
+TRACE_CACHE_ENTRY_REGEX = re.compile(r'[0-9a-f]{40}\.json')
+
+
+def trace_cache_path(cache_dir, trace_file):
+    return os.path.join(cache_dir, hashlib.sha1(trace_file.encode('utf-8')).hexdigest() + '.json')
+
+
+def encode_cached_aggregates(aggregates):
+    """Encode the aggregates of a trace for its cache entry.
+
+    Names are stored once in a table shared by all tallies, since the same
+    symbols and headers appear in several of them. Each tally is a flat
+    list of [name index, count, duration] rows."""
+    names = {}
+    totals = {}
+    tallies = {}
+    for key, value in aggregates.items():
+        if isinstance(value, dict):
+            rows = []
+            for name, [count, dur] in value.items():
+                index = names.setdefault(name, len(names))
+                rows += [index, count, dur]
+            tallies[key] = rows
+        else:
+            totals[key] = value
+    return {'names': list(names), 'totals': totals, 'tallies': tallies}
+
+
+def decode_cached_aggregates(encoded):
+    """Decode the aggregates written by encode_cached_aggregates."""
+    names = encoded['names']
+    aggregates = {key: tuple(value) for key, value in encoded['totals'].items()}
+    for key, rows in encoded['tallies'].items():
+        aggregates[key] = {names[rows[i]]: (rows[i + 1], rows[i + 2]) for i in range(0, len(rows), 3)}
+    return aggregates
+
+
+def process_trace_cached(trace_file, context):
+    """Process a trace file, reusing the cached results if the file hasn't changed.
+
+    Cache entries are keyed by the trace path, modification time and size,
+    and are only reused if they were created with the same settings.
+
+    Entries only hold the report data, which is much smaller than the
+    events. When the combined trace is written, the events of a cached
+    file are read again from the trace without aggregating them."""
+    cache_dir = context.get('cache_dir')
+    if cache_dir is None:
+        return process_trace(trace_file, context)
+
+    stat = os.stat(trace_file)
+    key = {
+        'trace_file': trace_file,
+        'mtime': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'filename': trace_display_name(trace_file, context),
+        'fingerprint': context['cache_fingerprint'],
+    }
+    entry_path = trace_cache_path(cache_dir, trace_file)
+    try:
+        with open(entry_path, 'r') as f:
+            entry = json.load(f)
+        if entry['key'] == key:
+            log(f'{key["filename"]}: using cached results')
+            [filename, file_total_time, first_ts, aggregates] = entry['result']
+            events = []
+            if context.get('emit_events', True):
+                events = load_trace_events(trace_file, filename, context)
+            return filename, events, file_total_time, first_ts, decode_cached_aggregates(aggregates)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    result = process_trace(trace_file, context)
+    [filename, events, file_total_time, first_ts, aggregates] = result
+    tmp_path = f'{entry_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'key': key, 'result': [filename, file_total_time, first_ts, encode_cached_aggregates(aggregates)]},
+                  f, separators=(',', ':'))
+    os.replace(tmp_path, entry_path)
+    return result
+
+
+def prune_trace_cache(cache_dir, trace_files):
+    """Remove the cache entries of trace files that no longer exist.
+
+    Only files named like cache entries are removed, so other JSON files
+    in the directory, such as compile_commands.json, are kept."""
+    entries = {os.path.basename(trace_cache_path(cache_dir, trace_file)) for trace_file in trace_files}
+    for entry in os.listdir(cache_dir):
+        if TRACE_CACHE_ENTRY_REGEX.fullmatch(entry) and entry not in entries:
+            os.remove(os.path.join(cache_dir, entry))
+
+
+def prune_trace_events(events, min_duration=0, max_events=None):
+    """Drop short events from a trace, keeping the nesting of the remaining events valid.
+
+    Events shorter than `min_duration` and events that are not among the
+    `max_events` longest ones are dropped, along with all their descendants.
+    Each run of consecutive dropped siblings is replaced by a single "Other"
+    event with their total duration, so the time in each parent still adds up.
+
+    Returns the remaining events, the number of dropped events and the
+    total duration of the time folded into "Other" events."""
+    if min_duration <= 0 and max_events is None:
+        return events, 0, 0
+
+    def duration(event):
+        return int(event.get('dur', 0))
+
+    longest = None
+    if max_events is not None:
+        longest = {id(event) for event in sorted(events, key=duration, reverse=True)[:max_events]}
+
+    kept_events = []
+    dropped_count = 0
+    dropped_time = 0
+
+    def flush(entry):
+        run = entry[2]
+        if run is not None:
+            [ts, dur, count] = run
+            kept_events.append({'name': 'Other', 'cat': 'Other', 'ph': 'X', 'ts': ts, 'dur': dur,
+                                'args': {'detail': f'{count} short events', 'count': count}})
+            entry[2] = None
+
+    # Enclosing events as [end, kept, run of dropped children]
+    stack = [[float('inf'), True, None]]
+    for event in sorted(events, key=lambda x: (int(x['ts']), -duration(x))):
+        ts = int(event['ts'])
+        dur = duration(event)
+        while len(stack) > 1 and ts >= stack[-1][0]:
+            flush(stack.pop())
+        parent = stack[-1]
+        kept = False
+        if not parent[1]:
+            # Already included in the duration of a dropped ancestor
+            dropped_count += 1
+        elif dur >= min_duration and (longest is None or id(event) in longest):
+            kept = True
+            flush(parent)
+            kept_events.append(event)
+        else:
+            dropped_count += 1
+            dropped_time += dur
+            if parent[2] is None:
+                parent[2] = [ts, 0, 0]
+            parent[2][1] += dur
+            parent[2][2] += 1
+        stack.append([ts + dur, kept, None])
+    while stack:
+        flush(stack.pop())
+    return kept_events, dropped_count, dropped_time
+
+
+def load_trace(trace_file, context):
+    """Process a trace file, reusing cached results if possible, and prune the events to emit."""
+    filename, trace_events, file_total_time, first_ts, aggregates = process_trace_cached(trace_file, context)
+    trace_events, dropped_count, dropped_time = prune_trace_events(
+        trace_events, context.get('min_duration', 0), context.get('max_events'))
+    aggregates['total_pruned'] = (dropped_count, dropped_time)
+    return filename, trace_events, file_total_time, first_ts, aggregates
+
+
+# Context shared with the worker processes
+worker_context = None
+
+
+def init_worker(context, worker_verbose):
+    global worker_context, verbose
+    worker_context = context
+    verbose = worker_verbose
+
+
+def process_trace_in_worker(trace_file):
+    return load_trace(trace_file, worker_context)
+
+
+def process_traces(trace_files, context, jobs=1):
+    """Process the trace files, in parallel when jobs > 1.
+
+    Results are yielded in the same order as `trace_files`, regardless of
+    the order in which the workers finish, so the output is deterministic.
+    At most two files per worker are in flight, so results don't pile up
+    in memory while the caller writes the previous ones."""
+    if jobs <= 1 or len(trace_files) <= 1:
+        for trace_file in trace_files:
+            yield load_trace(trace_file, context)
+        return
+
+    jobs = min(jobs, len(trace_files))
+    with multiprocessing.Pool(jobs, initializer=init_worker, initargs=(context, verbose)) as pool:
+        pending = collections.deque()
+        remaining = iter(trace_files)
+        for trace_file in itertools.islice(remaining, 2 * jobs):
+            pending.append(pool.apply_async(process_trace_in_worker, (trace_file,)))
+        while pending:
+            result = pending.popleft().get()
+            # Keep the workers busy while the caller handles this result
+            for trace_file in itertools.islice(remaining, 1):
+                pending.append(pool.apply_async(process_trace_in_worker, (trace_file,)))
+            yield result
+
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['diff']:
+        sys.exit(diff_main(sys.argv[2:]))
+
     parser = argparse.ArgumentParser(description='Installs the dependencies needed to test a Boost library.')
     parser.add_argument('--source-dir', help="directory to scan", default=os.getcwd())
     parser.add_argument('--build-dir', help="directory to scan", default=os.getcwd())
-    parser.add_argument('-o', '--output', help="output file", default='combined-traces.json')
+    parser.add_argument('-o', '--output', help="output file (compressed with gzip if it ends with .gz)",
+                        default='combined-traces.json')
+    parser.add_argument('--no-output', action='store_true',
+                        help="don't write the combined trace, so the events of each file are not kept")
     parser.add_argument('--report-output', help="output file", default='time-trace-report.md')
+    parser.add_argument('--time-report-dir',
+                        help="directory with the GCC -ftime-report or MSVC /d1reportTime output of each "
+                             "translation unit, in .txt or .log files named after their object or source file")
+    parser.add_argument('--folded-output',
+                        help="also save the exclusive time of each stack of events as folded stacks "
+                             "('a;b;c <us>'), with identical stacks of all files merged")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of trace files to process in parallel (0 to use all CPUs)")
+    parser.add_argument('--timeline', choices=['serial', 'real'], default='serial',
+                        help="lay out files one after the other ('serial') or at the time they were compiled, "
+                             "in parallel lanes ('real'). Real start times come from the .ninja_log in "
+                             "the build directory or from the time-trace files.")
+    parser.add_argument('--min-duration-us', type=int, default=0,
+                        help="drop events shorter than this from the combined trace")
+    parser.add_argument('--max-events-per-trace', type=int,
+                        help="only keep the longest events of each trace file in the combined trace")
+    parser.add_argument('--pch-output',
+                        help="generate a precompiled header with the most expensive headers included by "
+                             "several files, and a CMake snippet with the same headers next to it")
+    parser.add_argument('--pch-budget-kb', type=int, default=2048,
+                        help="maximum size of the headers in the precompiled header, including the headers "
+                             "they include")
+    parser.add_argument('--pch-target', default='${PROJECT_NAME}',
+                        help="CMake target in the target_precompile_headers snippet")
+    parser.add_argument('--symbol-grouping', choices=SYMBOL_GROUPINGS, default='primary',
+                        help="group instantiations by their primary template ('primary'), by their primary "
+                             "template and first template argument ('first-argument'), or by their namespace "
+                             "('namespace')")
+    parser.add_argument('--snapshot-output',
+                        help="save the totals and the file and symbol tallies in a SQLite file that can be "
+                             "compared with another build with the 'diff' subcommand")
+    parser.add_argument('--cache-dir',
+                        help="directory where the results for each trace file are cached between runs")
     parser.add_argument('--verbose', action='store_true', help="Verbose mode")
     args = parser.parse_args()
 
@@ -115,23 +1928,32 @@ if __name__ == '__main__':
 
     # Find trace files
     trace_files = find_trace_files(build_dir)
+    time_report_dir = None
+    if args.time_report_dir:
+        time_report_dir = os.path.join(build_dir, args.time_report_dir)
+        trace_files += find_time_reports(time_report_dir)
     log(f'{len(trace_files)} trace files')
     log([os.path.relpath(trace_file, build_dir) for trace_file in trace_files])
 
-    # Open trace files
-    traces = []
-    for filename in trace_files:
-        with open(filename, 'r') as f:
-            traces.append((filename, json.load(f)))
-    log('Time-trace files loaded')
-
     # Find CMake compile_commands.json
     compile_commands = load_compile_commands(build_dir)
 
+    compile_commands_index = index_compile_commands(compile_commands)
+    log(f'{len(compile_commands_index)} compile command outputs indexed')
+
     # Include dirs used in compilation, so we can determine which are reasonable relative paths for files
-    include_paths = []
+    # Many compile commands share the same flags, so each distinct command is only scanned once
+    include_paths = {}
+    commands = {}
     for compile_command in compile_commands:
-        include_paths += extract_include_paths(compile_command['command'])
+        if 'command' in compile_command:
+            commands[compile_command['command']] = None
+        else:
+            commands[' '.join(compile_command['arguments'])] = None
+    for command in commands:
+        include_paths.update(dict.fromkeys(extract_include_paths(command)))
+    include_paths = list(include_paths)
+    del commands
     PATH = os.getenv('PATH')
     if PATH:
         include_paths += PATH.split(':')
@@ -139,181 +1961,139 @@ if __name__ == '__main__':
     include_paths.append('/usr/local/include')
     include_paths.append('/usr/include/c++')
 
+    context = {
+        'source_dir': source_dir,
+        'build_dir': build_dir,
+        'compile_commands_index': compile_commands_index,
+        'normalize_path': PathNormalizer(source_dir, build_dir, include_paths),
+        'min_duration': args.min_duration_us,
+        'max_events': args.max_events_per_trace,
+        'time_report_dir': time_report_dir,
+        'folded_stacks': args.folded_output is not None,
+        'emit_events': not args.no_output,
+    }
+
+    # Results of trace files that haven't changed since the last run
+    cache_dir = None
+    if args.cache_dir:
+        cache_dir = os.path.join(build_dir, args.cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        prune_trace_cache(cache_dir, trace_files)
+        context['cache_dir'] = cache_dir
+        context['cache_fingerprint'] = trace_cache_fingerprint(source_dir, build_dir, include_paths,
+                                                               context['folded_stacks'])
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    log(f'Processing traces with {jobs} jobs')
+
     # Report data
-    total_compile: {int} = (0, 0)
-    # Frontend: parsing and instantiations
-    total_frontend: {int} = (0, 0)
-    total_parsing: {int} = (0, 0)
-    total_instantiations: {int} = (0, 0)
-    # Backend: code generation and optimizations
-    total_backend: {int} = (0, 0)
-    total_codegen: {int} = (0, 0)
-    total_optimize: {int} = (0, 0)
-    # Individual files and symbols
-    file_compile: {str, tuple} = {}
-    file_parse: {str, tuple} = {}
-    symbol_parse: {str, tuple} = {}
-    symbol_instantiate: {str, tuple} = {}
+    aggregates = new_aggregates()
+
+    # Steps of the last ninja build, to attribute wall-clock time
+    ninja_log = read_ninja_log(build_dir)
+    critical_path = ninja_critical_path(ninja_log)
+    critical_outputs = set(critical_path)
+    wall_shares = ninja_wall_shares(ninja_log)
+    # Time each file, header and symbol contributes to the critical path and to the wall-clock time
+    critical_compile: {str, tuple} = {}
+    critical_parse: {str, tuple} = {}
+    critical_instantiate: {str, tuple} = {}
+    wall_compile: {str, tuple} = {}
+    wall_parse: {str, tuple} = {}
+    wall_instantiate: {str, tuple} = {}
+
+    # In the real timeline, files are processed in the order they started compiling
+    real_timeline = args.timeline == 'real'
+    if real_timeline:
+        trace_start_times, from_ninja_log = find_trace_start_times(trace_files, build_dir, ninja_log,
+                                                                   time_report_dir)
+        log(f'Start times from {".ninja_log" if from_ninja_log else "time-trace files"}')
+        trace_files = sorted(trace_files, key=lambda trace_file: trace_start_times[trace_file])
+        timeline_origin = min(trace_start_times.values(), default=0)
+    # End time of the last file in each lane
+    lane_ends = []
+    # Start, end, and lane of each file
+    lane_intervals = []
 
     # Combine time-trace content
     start_time = 0
-    combined_data = []
-    file_total_time = 0
-    for [filename, trace] in traces:
-        # Adjust filename
-        filename = os.path.relpath(filename, build_dir)
-        filename = filename[:-5]
-        for compile_command in compile_commands:
-            if compile_command['command'].find(filename) != -1:
-                filename = compile_command['file']
-                filename = os.path.relpath(filename, source_dir)
-                break
-        filename = filename.replace('CMakeFiles/', '')
-        segments = filename.split('/')
-        segments = [f'{{{segment[:-4]}}}' if segment.endswith('.dir') else segment for segment in segments]
-        filename = '/'.join(segments)
-        if filename.find('../') != -1:
-            filename = os.path.abspath(filename)
-
-        # regions already accounted for
-        parsing_regions = []
-        instantiation_regions = []
-
-        sorted_events = sorted(trace['traceEvents'], key=lambda x: 0 if 'dur' not in x else int(x['dur']), reverse=True)
-        for event in sorted_events:
-            # Filter out very short events to reduce data size
-            event_is_too_short = event['ph'] == 'M' or event['name'].startswith('Total')
-            if event_is_too_short:
-                continue
-
-            # log('Event:', event)
-            # Adjust detail path
-            if 'args' in event and 'detail' in event['args']:
-                if type(event['args']['detail']) == str:
-                    if os.path.exists(event['args']['detail']):
-                        event['args']['detail'] = os.path.abspath(event['args']['detail'])
-                        if is_subpath(event['args']['detail'], source_dir):
-                            event['args']['detail'] = os.path.relpath(event['args']['detail'], source_dir)
-                        elif is_subpath(event['args']['detail'], build_dir):
-                            event['args']['detail'] = os.path.relpath(event['args']['detail'], build_dir)
-                        else:
-                            for include_path in include_paths:
-                                if is_subpath(event['args']['detail'], include_path):
-                                    event['args']['detail'] = os.path.relpath(event['args']['detail'], include_path)
-                                    break
-
-            # Store data for the report
-            if event['name'] == 'Source':
-                # add to total
-                ts = int(event['ts'])
-                dur = int(event['dur'])
-                accounted_for = False
-                for parsing_region in parsing_regions:
-                    if parsing_region[0] <= ts < parsing_region[1]:
-                        accounted_for = True
-                        break
-                if not accounted_for:
-                    total_parsing = (total_parsing[0] + 1, total_parsing[1] + dur)
-                    parsing_regions.append((ts, ts + dur))
-
-                # add to files total
-                file = event['args']['detail']
-                if file not in file_parse:
-                    file_parse[file] = (0, 0)
-                file_parse[file] = (file_parse[file][0] + 1, file_parse[file][1] + dur)
-
-            elif event['name'].startswith('Parse') and 'args' in event and 'detail' in event['args']:
-                # add to symbols total
-                dur = int(event['dur'])
-                symbol = event['args']['detail']
-                if symbol not in symbol_parse:
-                    symbol_parse[symbol] = (0, 0)
-                symbol_parse[symbol] = (symbol_parse[symbol][0] + 1, symbol_parse[symbol][1] + dur)
-
-            elif event['name'].startswith('Instantiate') and 'args' in event and 'detail' in event['args']:
-                # add to total
-                ts = int(event['ts'])
-                dur = int(event['dur'])
-                accounted_for = False
-                for instantiation_region in instantiation_regions:
-                    if instantiation_region[0] <= ts < instantiation_region[1]:
-                        accounted_for = True
-                        break
-                if not accounted_for:
-                    total_instantiations = (total_instantiations[0] + 1, total_instantiations[1] + dur)
-                    instantiation_regions.append((ts, ts + dur))
-
-                # add to symbol total
-                symbol = event['args']['detail']
-                if symbol not in symbol_instantiate:
-                    symbol_instantiate[symbol] = (0, 0)
-                symbol_instantiate[symbol] = (symbol_instantiate[symbol][0] + 1, symbol_instantiate[symbol][1] + dur)
-
-            elif event['name'] == 'PerformPendingInstantiations':
-                ts = int(event['ts'])
-                dur = int(event['dur'])
-                total_instantiations = (total_instantiations[0] + 1, total_instantiations[1] + dur)
-                instantiation_regions.append((ts, ts + dur))
-
-            elif event['name'] == 'Frontend':
-                total_frontend = (total_frontend[0] + 1, total_frontend[1] + int(event['dur']))
-            elif event['name'] == 'Backend':
-                total_backend = (total_backend[0] + 1, total_backend[1] + int(event['dur']))
-            elif event['name'] == 'Optimizer':
-                total_optimize = (total_optimize[0] + 1, total_optimize[1] + int(event['dur']))
-            elif event['name'] == 'CodeGenPasses':
-                total_codegen = (total_codegen[0] + 1, total_codegen[1] + int(event['dur']))
-            elif event['name'] == 'ExecuteCompiler':
-                # add to total
-                ts = int(event['ts'])
-                dur = int(event['dur'])
-                total_compile = (total_compile[0] + 1, total_compile[1] + dur)
-
-                # add to files total
-                if filename not in file_compile:
-                    file_compile[filename] = (0, 0)
-                file_compile[filename] = (file_compile[filename][0] + 1, file_compile[filename][1] + dur)
-
-            # Keep track of the main ExecuteCompiler event, which exists for each file
-            # Also adapt this event to include the file name
-            if event['name'] == 'ExecuteCompiler':
-                # Find how long this compilation took for this file
-                # This represents how long the whole object file took
-                # and can be used to shift the start time for the next file
-                file_total_time = event['dur']
-                log(f'{filename} took {format_time(file_total_time)}')
-                # Set the file name in ExecuteCompiler
-                if 'args' not in event:
-                    event['args'] = {}
-                event['args']['detail'] = filename
-
-            # Replace source event names with filename
-            if event['name'] == 'Source':
-                if 'args' in event and 'detail' in event['args']:
-                    event['name'] = event['args']['detail']
-                else:
-                    event['name'] = filename
-                event['cat'] = 'Source'
-
-            # Offset by start time to make events sequential in a single timeline
-            event['ts'] += start_time
-
-            # Put all events in the same pid
-            # Different pids tend to be rendered in different tabs in some
-            # visualizers, which is not what we want
-            event['pid'] = 0
-            event['tid'] = 0
+    with TraceEventWriter(None if args.no_output else output_path) as writer:
+        results = process_traces(trace_files, context, jobs)
+        for trace_file, [filename, trace_events, file_total_time, first_ts, partial_aggregates] in zip(trace_files,
+                                                                                                     results):
+            merge_aggregates(aggregates, partial_aggregates)
+
+            # Attribute the wall-clock time of this file to its headers and symbols
+            # in proportion to the time they took to compile. Headers and symbols are
+            # attributed their exclusive time, so nested includes and instantiations
+            # are not counted once per ancestor.
+            object_file = trace_object_file(trace_file, build_dir, time_report_dir)
+            if object_file in wall_shares and file_total_time > 0:
+                wall_factor = wall_shares[object_file] / file_total_time
+                add_scaled_tally(wall_compile, partial_aggregates['file_compile'], wall_factor)
+                add_scaled_tally(wall_parse, partial_aggregates['header_exclusive'], wall_factor)
+                add_scaled_tally(wall_instantiate, partial_aggregates['symbol_instantiate_exclusive'], wall_factor)
+                if object_file in critical_outputs:
+                    add_scaled_tally(critical_compile, partial_aggregates['file_compile'], 1)
+                    add_scaled_tally(critical_parse, partial_aggregates['header_exclusive'], 1)
+                    add_scaled_tally(critical_instantiate, partial_aggregates['symbol_instantiate_exclusive'], 1)
+                    for event in trace_events:
+                        if event['name'] == 'ExecuteCompiler':
+                            event['args']['critical_path'] = True
+
+            lane = 0
+            offset = start_time
+            if real_timeline:
+                offset = trace_start_times[trace_file] - timeline_origin
+                if from_ninja_log:
+                    offset -= first_ts
+                file_start = first_ts + offset
+                # Put the file in the first lane that is free when it starts
+                lane = next((i for i, end in enumerate(lane_ends) if end <= file_start), len(lane_ends))
+                if lane == len(lane_ends):
+                    lane_ends.append(0)
+                lane_ends[lane] = file_start + file_total_time
+                lane_intervals.append((file_start, file_start + file_total_time, lane))
+
+            for event in trace_events:
+                # Offset by start time to make events sequential in a single timeline
+                event['ts'] += offset
+
+                # Put all events in the same pid
+                # Different pids tend to be rendered in different tabs in some
+                # visualizers, which is not what we want
+                event['pid'] = 0
+                event['tid'] = lane
 
             # Add data to combined
-            combined_data.append(event)
-
-        # Increase the start time for the next file
-        # Add 1 to avoid issues with simultaneous events
-        start_time += file_total_time + 1
-
-    with open(output_path, 'w') as f:
-        json.dump({'traceEvents': sorted(combined_data, key=lambda k: k['ts'])}, f)
-        log('Saved to ', os.path.abspath(output_path))
+            writer.add(trace_events)
+            del trace_events
+
+            # Increase the start time for the next file
+            # Add 1 to avoid issues with simultaneous events
+            start_time += file_total_time + 1
+
+        if real_timeline:
+            writer.add_unsorted(lane_events(lane_intervals))
+    if not args.no_output:
+        log(f'Saved {writer.count} events to ', os.path.abspath(output_path))
+
+    if args.folded_output:
+        folded_path = os.path.join(build_dir, args.folded_output)
+        write_folded_stacks(folded_path, aggregates['folded_stacks'])
+        log(f'Saved {len(aggregates["folded_stacks"])} folded stacks to ', os.path.abspath(folded_path))
+
+    total_compile = aggregates['total_compile']
+    total_frontend = aggregates['total_frontend']
+    total_parsing = aggregates['total_parsing']
+    total_instantiations = aggregates['total_instantiations']
+    total_backend = aggregates['total_backend']
+    total_codegen = aggregates['total_codegen']
+    total_optimize = aggregates['total_optimize']
+    file_compile = aggregates['file_compile']
+    file_parse = aggregates['file_parse']
+    symbol_parse = aggregates['symbol_parse']
+    symbol_instantiate = aggregates['symbol_instantiate']
+    total_pruned = aggregates['total_pruned']
 
     # Report
     output = '# Time Trace\n\n'
@@ -336,6 +2116,29 @@ if __name__ == '__main__':
         output += f'| 2B) Optimization   | {round(100 * total_optimize[1] / total_compile[1], 2)}% | {format_time(total_optimize[1])} | {format_time(total_optimize[1] / total_optimize[0])} | {total_optimize[0]} |\n'
     output += '\n\n'
 
+    if total_pruned[0] != 0:
+        output += f'{total_pruned[0]} short events were dropped from the combined trace. '
+        output += f'Their {format_time(total_pruned[1])} are included in "Other" events.\n\n'
+
+    if real_timeline and lane_intervals:
+        timeline_start = min(start for [start, _, _] in lane_intervals)
+        timeline_end = max(end for [_, end, _] in lane_intervals)
+        wall_time = timeline_end - timeline_start
+        busy_time = sum(end - start for [start, end, _] in lane_intervals)
+        output += '## Timeline\n\n'
+        output += '| Lanes | Wall Time | Busy Time | Parallelism | Utilization |\n'
+        output += '| ----- | --------- | --------- | ----------- | ----------- |\n'
+        if wall_time != 0:
+            output += f'| {len(lane_ends)} | {format_time(wall_time)} | {format_time(busy_time)} | {round(busy_time / wall_time, 2)} | {round(100 * busy_time / (wall_time * len(lane_ends)), 2)}% |\n'
+        output += '\n\n'
+        output += '| Lane | Busy Time | Utilization | Files |\n'
+        output += '| ---- | --------- | ----------- | ----- |\n'
+        for lane in range(len(lane_ends)):
+            intervals = [end - start for [start, end, l] in lane_intervals if l == lane]
+            utilization = f'{round(100 * sum(intervals) / wall_time, 2)}%' if wall_time != 0 else '-'
+            output += f'| {lane} | {format_time(sum(intervals))} | {utilization} | {len(intervals)} |\n'
+        output += '\n\n'
+
     output += '## Files\n\n'
 
 
@@ -379,6 +2182,29 @@ if __name__ == '__main__':
     output += '### Parse\n\n'
     output += section_table('File', file_parse)
 
+    header_costs = include_costs(file_parse, aggregates['header_exclusive'], aggregates['include_edges'])
+    if header_costs:
+        output += '### Includes\n\n'
+        output += 'Headers with the largest inclusive parse time. '
+        output += '"If Removed" estimates the time saved if the header and the headers only reachable through it '
+        output += 'were no longer included. "Precompiled" estimates the time saved by moving the header into a '
+        output += 'precompiled header, where it is parsed once instead of once per file.\n\n'
+
+
+        def include_costs_table(rows):
+            table = '| Header | Inclusive | Exclusive | Files | Includers | If Removed | Precompiled |\n'
+            table += '| ------ | --------- | --------- | ----- | --------- | ---------- | ----------- |\n'
+            for [header, inclusive, exclusive, files, includers, if_removed, precompiled] in rows:
+                table += f'| `{header}` | {format_time(inclusive)} | {format_time(exclusive)} | {files} | {includers} | {format_time(if_removed)} | {format_time(precompiled)} |\n'
+            return table + '\n\n'
+
+
+        output += include_costs_table(header_costs[:8])
+        if len(header_costs) > 8:
+            output += '<details>\n<summary>More...</summary>\n\n'
+            output += include_costs_table(header_costs)
+            output += '</details>\n\n'
+
     output += '## Symbols\n\n'
 
     output += '### Parse\n\n'
@@ -388,27 +2214,10 @@ if __name__ == '__main__':
     output += '### Instantiate Sets\n\n'
 
 
-    def convert_template_string(input_string):
-        l = 0
-        output_str = ''
-        for c in input_string:
-            if l == 0:
-                output_str += c
-            if c == '<':
-                if l == 0:
-                    output_str += '$'
-                l += 1
-            elif c == '>':
-                l -= 1
-                if l == 0:
-                    output_str += c
-        return output_str
-
-
     symbol_set_instantiate: {str, tuple} = {}
     for [symbol, v] in symbol_instantiate.items():
         [count, time] = v
-        symbol_set = convert_template_string(symbol)
+        symbol_set = group_symbol(symbol, args.symbol_grouping)
         if symbol_set not in symbol_set_instantiate:
             symbol_set_instantiate[symbol_set] = (0, 0)
         symbol_set_instantiate[symbol_set] = (
@@ -416,10 +2225,6 @@ if __name__ == '__main__':
     output += section_table('Symbol Set', symbol_set_instantiate)
 
 
-    def is_std_symbol(symbol):
-        return symbol.startswith('std::') or symbol.startswith('__gnu_cxx::')
-
-
     output += '## Project Symbols\n\n'
     output += '### Parse\n\n'
     symbol_parse = {k: v for k, v in symbol_parse.items() if not is_std_symbol(k)}
@@ -431,7 +2236,87 @@ if __name__ == '__main__':
     symbol_set_instantiate = {k: v for k, v in symbol_set_instantiate.items() if not is_std_symbol(k)}
     output += section_table('Symbol Set', symbol_set_instantiate)
 
+    if ninja_log:
+        build_start = min(start for [start, _] in ninja_log.values())
+        build_end = max(end for [_, end] in ninja_log.values())
+        critical_time = sum(ninja_log[output][1] - ninja_log[output][0] for output in critical_path)
+        output += '## Wall-Clock\n\n'
+        output += 'Wall-clock time of the last build in `.ninja_log`. '
+        output += 'The critical path is estimated from the timing of the build steps: '
+        output += 'each step is preceded by the step that finished most recently before it started.\n\n'
+        output += '| Build Steps | Wall Time | Critical Path | Critical Path Steps |\n'
+        output += '| ----------- | --------- | ------------- | ------------------- |\n'
+        output += f'| {len(ninja_log)} | {format_time(build_end - build_start)} | {format_time(critical_time)} | {len(critical_path)} |\n'
+        output += '\n\n'
+
+        output += '### Critical Path\n\n'
+        output += '| Step | Start | Duration |\n'
+        output += '| ---- | ----- | -------- |\n'
+        for critical_output in critical_path:
+            [start, end] = ninja_log[critical_output]
+            output += f'| `{critical_output}` | {format_time(start - build_start)} | {format_time(end - start)} |\n'
+        output += '\n\n'
+
+        if critical_compile:
+            output += 'Time that files, headers and symbols add to the critical path.\n\n'
+            output += '### Critical Path Files\n\n'
+            output += section_table('File', critical_compile)
+            output += '### Critical Path Headers\n\n'
+            output += section_table('File', critical_parse)
+            output += '### Critical Path Instantiations\n\n'
+            output += section_table('Symbol', critical_instantiate)
+
+        if wall_compile:
+            output += 'Wall-clock time attributed to files, headers and symbols. '
+            output += 'At each moment, the elapsed time is shared equally among the steps running in parallel, '
+            output += 'and the share of each file is split in proportion to the time its headers and symbols took, '
+            output += 'where the time of a header excludes the headers it includes and the time of a symbol excludes '
+            output += 'the instantiations nested in it.\n\n'
+            output += '### Wall-Clock Files\n\n'
+            output += section_table('File', wall_compile)
+            output += '### Wall-Clock Headers\n\n'
+            output += section_table('File', wall_parse)
+            output += '### Wall-Clock Instantiations\n\n'
+            output += section_table('Symbol', wall_instantiate)
+
+    if args.pch_output:
+        pch_path = os.path.join(build_dir, args.pch_output)
+        search_dirs = [source_dir, build_dir] + include_paths
+        pch_headers = select_precompiled_headers(file_parse, aggregates['header_exclusive'],
+                                                 aggregates['include_edges'], search_dirs, include_paths,
+                                                 args.pch_budget_kb * 1024)
+        pch = '// Precompiled header generated by combine-traces.py\n'
+        pch += '// Headers are sorted by their total parse time in the time-traces\n\n'
+        pch += '#pragma once\n\n'
+        cmake = '# Precompiled headers generated by combine-traces.py\n'
+        cmake += f'target_precompile_headers({args.pch_target} PRIVATE\n'
+        for [header, spelling, score, savings, size] in sorted(pch_headers, key=lambda x: x[2], reverse=True):
+            pch += f'#include {spelling}\n'
+            cmake += f'    {spelling}\n' if spelling.startswith('<') else f'    [[{spelling}]]\n'
+        cmake += ')\n'
+        with open(pch_path, 'w') as f:
+            f.write(pch)
+        cmake_path = os.path.splitext(pch_path)[0] + '.cmake'
+        with open(cmake_path, 'w') as f:
+            f.write(cmake)
+        log('Precompiled header saved to ', os.path.abspath(pch_path))
+
+        output += '## Precompiled Header\n\n'
+        output += f'Headers chosen for `{os.path.basename(pch_path)}` under a budget of {args.pch_budget_kb} KB. '
+        output += '"Savings" estimates the parse time saved if each header is parsed once in the precompiled header '
+        output += 'instead of once per file.\n\n'
+        output += '| Header | Total Parse Time | Savings | Size |\n'
+        output += '| ------ | ---------------- | ------- | ---- |\n'
+        for [header, spelling, score, savings, size] in sorted(pch_headers, key=lambda x: x[2], reverse=True):
+            output += f'| `{spelling}` | {format_time(score)} | {format_time(savings)} | {round(size / 1024, 2)} KB |\n'
+        output += '\n\n'
+
     log(output)
     with open(report_path, 'w') as f:
         f.write(output)
         log('Report saved to ', os.path.abspath(report_path))
+
+    if args.snapshot_output:
+        snapshot_path = os.path.join(build_dir, args.snapshot_output)
+        write_snapshot(snapshot_path, aggregates)
+        log('Snapshot saved to ', os.path.abspath(snapshot_path))
@@ -0,0 +1,224 @@
+#
+# Copyright (c) 2023 Alan de Freitas (alandefreitas@gmail.com)
+#
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE_1_0.txt or copy at http://www.boost.org/LICENSE_1_0.txt)
+#
+# Official repository: https://github.com/alandefreitas/cpp-actions
+#
+
+"""Generate synthetic clang -ftime-trace files to test combine-traces.py.
+
+The traces are laid out as in a CMake build directory: each translation
+unit has a <name>.cpp.json trace next to an empty <name>.cpp.o object file,
+and a compile_commands.json lists the commands that would compile them.
+With --ninja-jobs, a .ninja_log records a parallel build of the objects.
+
+Each translation unit includes headers from a shared pool, where each
+header includes `--fan-out` other headers, so the same headers and symbols
+show up in many files as in a real project. The output only depends on
+the options, so the same options always generate the same files.
+
+Run with (e.g.): python generate-traces.py --output-dir build --tus 100"""
+
+import argparse
+import json
+import os
+import random
+
+
+def make_symbol(rng, length, pool):
+    """A nested template name with about `length` characters."""
+    names = [f'synthetic::ns{rng.randrange(pool)}::type{rng.randrange(pool)}']
+    while sum(len(name) + 1 for name in names) + 1 < length:
+        names.append(f'synthetic::ns{rng.randrange(pool)}::type{rng.randrange(pool)}')
+    if len(names) == 1:
+        return names[0]
+    return '<'.join(names) + '>' * (len(names) - 1)
+
+
+def header_path(output_dir, header):
+    return os.path.join(output_dir, 'include', 'synthetic', f'header{header}.hpp')
+
+
+def header_includes(seed, header, headers, fan_out):
+    """The headers included by a header, which are the same in every translation unit."""
+    rng = random.Random(f'{seed}:header:{header}')
+    candidates = range(header + 1, headers)
+    return rng.sample(candidates, min(fan_out, len(candidates)))
+
+
+def include_tree(rng, output_dir, seed, headers, fan_out, depth, budget):
+    """Source events for the headers included by a translation unit.
+
+    Headers are only parsed the first time they are included, as if
+    they had include guards."""
+    visited = set()
+    sources = []
+
+    def visit(header, level):
+        if header in visited or len(sources) >= budget:
+            return None
+        visited.add(header)
+        node = ['Source', header_path(output_dir, header), rng.randrange(10, 2000), []]
+        sources.append(node)
+        if level < depth:
+            for child in header_includes(seed, header, headers, fan_out):
+                child_node = visit(child, level + 1)
+                if child_node is not None:
+                    node[3].append(child_node)
+        return node
+
+    roots = []
+    for header in rng.sample(range(headers), min(fan_out, headers)):
+        node = visit(header, 1)
+        if node is not None:
+            roots.append(node)
+    return roots, sources
+
+
+def instantiation_tree(rng, symbol_length, pool, depth, budget):
+    """Nested InstantiateClass and InstantiateFunction events."""
+    name = rng.choice(['InstantiateClass', 'InstantiateFunction'])
+    node = [name, make_symbol(rng, symbol_length, pool), rng.randrange(5, 3000), []]
+    count = 1
+    while count < budget and depth > 1 and rng.random() < 0.6:
+        child, child_count = instantiation_tree(rng, symbol_length, pool, depth - 1, budget - count)
+        node[3].append(child)
+        count += child_count
+    return node, count
+
+
+def layout(node, ts, events, pid):
+    """Add the events of a tree starting at `ts` and return the end of the root event.
+
+    Each event lasts for its own time plus the time of its children, so the
+    events are nested as in clang traces."""
+    name, detail, self_time, children = node
+    end = ts + self_time // 2
+    for child in children:
+        end = layout(child, end, events, pid)
+    end += self_time - self_time // 2
+    event = {'pid': pid, 'tid': pid, 'ph': 'X', 'ts': ts, 'dur': end - ts, 'name': name}
+    if detail is not None:
+        event['args'] = {'detail': detail}
+    events.append(event)
+    return end
+
+
+def generate_trace(output_dir, tu, args):
+    """The events of the time-trace of a translation unit."""
+    rng = random.Random(f'{args.seed}:tu:{tu}')
+    pid = 1000 + tu
+    budget = max(args.events - 8, 0)
+
+    # Headers and the declarations parsed in them
+    roots, sources = include_tree(rng, output_dir, args.seed, args.headers, args.fan_out, args.depth,
+                                  budget * 2 // 5)
+    parse_budget = budget * 3 // 10
+    for _ in range(parse_budget if sources else 0):
+        name = rng.choice(['ParseClass', 'ParseDeclarationOrFunctionDefinition', 'ParseFunctionDefinition'])
+        symbol = make_symbol(rng, args.symbol_length, args.headers)
+        rng.choice(sources)[3].append([name, symbol, rng.randrange(5, 500), []])
+
+    # Templates instantiated at the end of the translation unit
+    instantiations = []
+    instantiation_budget = budget - len(sources) - (parse_budget if sources else 0)
+    while instantiation_budget > 0:
+        node, count = instantiation_tree(rng, args.symbol_length, args.headers, args.depth, instantiation_budget)
+        instantiations.append(node)
+        instantiation_budget -= count
+
+    frontend = ['Frontend', None, rng.randrange(100, 5000), roots]
+    if instantiations:
+        frontend[3].append(['PerformPendingInstantiations', None, rng.randrange(10, 1000), instantiations])
+    backend = ['Backend', None, rng.randrange(100, 5000), [
+        ['OptModule', 'synthetic.cpp', rng.randrange(100, 20000), []],
+        ['CodeGenPasses', None, rng.randrange(100, 20000), []],
+    ]]
+    compiler = ['ExecuteCompiler', None, rng.randrange(100, 2000), [frontend, backend]]
+
+    events = [
+        {'cat': '', 'pid': pid, 'tid': pid, 'ts': 0, 'ph': 'M', 'name': 'process_name', 'args': {'name': 'clang'}},
+        {'cat': '', 'pid': pid, 'tid': pid, 'ts': 0, 'ph': 'M', 'name': 'thread_name', 'args': {'name': 'clang++'}},
+    ]
+    end = layout(compiler, 0, events, pid)
+    events.append({'pid': pid, 'tid': pid, 'ph': 'X', 'ts': 0, 'dur': end, 'name': 'Total ExecuteCompiler',
+                   'args': {'count': 1, 'avg ms': end // 1000}})
+    return events
+
+
+def write_ninja_log(output_dir, steps, jobs):
+    """Write a .ninja_log where the steps run on `jobs` parallel lanes in order.
+
+    Each step is an (output, duration in microseconds) pair and starts as soon
+    as a lane is free. Ninja logs times in milliseconds, so each step lasts
+    at least as long as its compilation."""
+    lane_ends = [0] * jobs
+    entries = []
+    for output, dur in steps:
+        lane = lane_ends.index(min(lane_ends))
+        start = lane_ends[lane]
+        lane_ends[lane] = start + dur // 1000 + 1
+        entries.append((lane_ends[lane], start, output))
+    # Ninja logs the steps as they finish
+    with open(os.path.join(output_dir, '.ninja_log'), 'w') as f:
+        f.write('# ninja log v5\n')
+        for end, start, output in sorted(entries):
+            f.write(f'{start}\t{end}\t0\t{output}\t0\n')
+
+
+def generate_build_dir(output_dir, args):
+    """Write the traces, object files and compile_commands.json. Returns the number of events."""
+    output_dir = os.path.abspath(output_dir)
+    object_dir = os.path.join(output_dir, 'CMakeFiles', 'synthetic.dir', 'src')
+    os.makedirs(object_dir, exist_ok=True)
+    compile_commands = []
+    steps = []
+    event_count = 0
+    for tu in range(args.tus):
+        name = f'tu{tu}.cpp'
+        events = generate_trace(output_dir, tu, args)
+        event_count += len(events)
+        with open(os.path.join(object_dir, name + '.json'), 'w') as f:
+            json.dump({'traceEvents': events, 'beginningOfTime': 1700000000000000 + tu * 1000},
+                      f, separators=(',', ':'))
+        with open(os.path.join(object_dir, name + '.o'), 'w'):
+            pass
+        object_file = os.path.relpath(os.path.join(object_dir, name + '.o'), output_dir)
+        steps.append((object_file, events[-1]['dur']))
+        source_file = os.path.join(output_dir, 'src', name)
+        compile_commands.append({
+            'directory': output_dir,
+            'command': f'/usr/bin/clang++ -I{os.path.join(output_dir, "include")} -ftime-trace '
+                       f'-o {object_file} -c {source_file}',
+            'file': source_file,
+        })
+    with open(os.path.join(output_dir, 'compile_commands.json'), 'w') as f:
+        json.dump(compile_commands, f, indent=2)
+    if args.ninja_jobs > 0:
+        write_ninja_log(output_dir, steps, args.ninja_jobs)
+    return event_count
+
+
+def add_generator_arguments(parser):
+    parser.add_argument('--events', type=int, default=200, help="number of events in each translation unit")
+    parser.add_argument('--depth', type=int, default=8, help="maximum nesting depth of includes and instantiations")
+    parser.add_argument('--headers', type=int, default=500, help="number of headers in the project")
+    parser.add_argument('--fan-out', type=int, default=4, help="number of headers included by each file")
+    parser.add_argument('--symbol-length', type=int, default=80, help="approximate length of the symbol names")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the generated traces")
+    parser.add_argument('--ninja-jobs', type=int, default=0,
+                        help="also write a .ninja_log as if the translation units were built with this many "
+                             "parallel jobs")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic clang time-trace files.')
+    parser.add_argument('--output-dir', help="build directory where the files are generated", default=os.getcwd())
+    parser.add_argument('--tus', type=int, default=10, help="number of translation units")
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    event_count = generate_build_dir(args.output_dir, args)
+    print(f'Generated {args.tus} traces with {event_count} events in {os.path.abspath(args.output_dir)}')
@@ -0,0 +1,80 @@
+#
+# Copyright (c) 2023 Alan de Freitas (alandefreitas@gmail.com)
+#
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE_1_0.txt or copy at http://www.boost.org/LICENSE_1_0.txt)
+#
+# Official repository: https://github.com/alandefreitas/cpp-actions
+#
+
+"""Tests of combine-traces.py on synthetic builds from generate-traces.py.
+
+Run with (e.g.): python -m unittest discover -s flamegraph"""
+
+import argparse
+import importlib.util
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location('generate_traces', os.path.join(script_dir, 'generate-traces.py'))
+generate_traces = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(generate_traces)
+
+TIME_UNITS = {'µs': 1, 'ms': 1000, 's': 1000000, 'min': 60000000, 'h': 3600000000}
+
+
+def parse_time(text):
+    """Microseconds in a time formatted by format_time."""
+    value, unit = text.split()
+    return float(value) * TIME_UNITS[unit]
+
+
+def section_totals(report):
+    """The total time of each section of the report, in microseconds."""
+    return {heading: parse_time(total)
+            for heading, total in re.findall(r'^### (.+)\n\nTotal Time: (.+)$', report, re.MULTILINE)}
+
+
+class WallClockAttributionTest(unittest.TestCase):
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp(prefix='combine-traces-test-')
+        parser = argparse.ArgumentParser()
+        generate_traces.add_generator_arguments(parser)
+        args = parser.parse_args(['--events', '300', '--ninja-jobs', '4'])
+        args.tus = 40
+        generate_traces.generate_build_dir(self.build_dir, args)
+
+    def tearDown(self):
+        shutil.rmtree(self.build_dir, ignore_errors=True)
+
+    def test_sections_fit_in_the_build_time(self):
+        subprocess.run([sys.executable, os.path.join(script_dir, 'combine-traces.py'),
+                        '--build-dir', self.build_dir, '--source-dir', self.build_dir],
+                       stdout=subprocess.DEVNULL, check=True)
+        with open(os.path.join(self.build_dir, 'time-trace-report.md'), 'r') as f:
+            report = f.read()
+        m = re.search(r'^\| Build Steps .*\n.*\n\| \d+ \| (.+?) \| (.+?) \| \d+ \|$', report, re.MULTILINE)
+        self.assertIsNotNone(m, 'the report has no wall-clock summary')
+        wall_time = parse_time(m.group(1))
+        critical_time = parse_time(m.group(2))
+        totals = section_totals(report)
+        # Times in the report are rounded to two decimals
+        for section, limit in [('Wall-Clock Files', wall_time), ('Wall-Clock Headers', wall_time),
+                               ('Wall-Clock Instantiations', wall_time), ('Critical Path Files', critical_time),
+                               ('Critical Path Headers', critical_time),
+                               ('Critical Path Instantiations', critical_time)]:
+            self.assertIn(section, totals)
+            self.assertLessEqual(totals[section], limit * 1.01, section)
+        self.assertLessEqual(totals['Wall-Clock Headers'] + totals['Wall-Clock Instantiations'], wall_time * 1.01)
+        self.assertLessEqual(totals['Critical Path Headers'] + totals['Critical Path Instantiations'],
+                             critical_time * 1.01)
+
+
+if __name__ == '__main__':
+    unittest.main()